@@ -0,0 +1,235 @@
+"""
+Vilo Benchmarks: In-process, no network.
+
+Drives `app.wsgi` with synthetic environ dicts, and reports
+requests/sec per scenario, plus per-stage timings.
+
+Usage:
+    python benchmark.py                             # Run all scenarios.
+    python benchmark.py -n 20000 hello jsonPost     # Select scenarios.
+    python benchmark.py --save base.json            # Save baseline.
+    python benchmark.py --compare base.json         # Flag regressions.
+""";
+
+import io;
+import os;
+import sys;
+import json;
+import time;
+import tempfile;
+import argparse;
+
+import vilo;
+
+# Helpers: #################################################
+
+def mkEnviron (verb, path, body=b"", **extra):
+    "Makes a minimal WSGI environ.";
+    environ = {
+        "REQUEST_METHOD": verb, "PATH_INFO": path,
+        "wsgi.input": io.BytesIO(body), "wsgi.url_scheme": "http",
+        "SERVER_NAME": "localhost", "SERVER_PORT": "80",
+    };
+    if body:
+        environ["CONTENT_LENGTH"] = str(len(body));
+    environ.update(extra);
+    return environ;
+
+def noop_start_response (statusLine, headerList, excInfo=None):
+    return None;
+
+def consume (wsgiOut):
+    "Consumes (and closes) WSGI iterable `wsgiOut`, like a server would.";
+    for chunk in wsgiOut:
+        pass;
+    if hasattr(wsgiOut, "close"):
+        wsgiOut.close();
+
+def mkScenario (name, app, verb, path, body=b"", **extra):
+    "Returns scenario dict, with a fresh-environ producer.";
+    def mkEnv ():
+        return mkEnviron(verb, path, body, **extra);
+    return {"name": name, "app": app, "mkEnv": mkEnv};
+
+# Scenarios: ###############################################
+
+ROUTE_TABLE_SIZE = 500;
+
+def buildScenarioList (staticDir):
+    scenarioList = [];
+    add = lambda *a, **k: scenarioList.append(mkScenario(*a, **k));
+
+    # Hello world:
+    app = vilo.buildApp();
+    app.route("GET", "/")(lambda req, res: "Hello, World!");
+    add("hello", app, "GET", "/");
+    add("notFound", app, "GET", "/nope");
+
+    # Large route table, exact + wildcard + regex:
+    app = vilo.buildApp();
+    for i in range(ROUTE_TABLE_SIZE // 3 + 1):
+        app.route("GET", "/exact/%d" % i)(lambda req, res: "exact");
+        app.route("GET", "/wild/%d/*" % i)(lambda req, res: req.wildcards[0]);
+        app.route("GET", r"/re/%d/(\d+)" % i)(lambda req, res: "re");
+    last = ROUTE_TABLE_SIZE // 3;
+    add("routesExact", app, "GET", "/exact/%d" % last);
+    add("routesWildcard", app, "GET", "/wild/%d/foo" % last);
+    add("routesRegex", app, "GET", "/re/%d/123" % last);
+    add("routesNotFound", app, "GET", "/missing/route");
+
+    # Request bodies:
+    app = vilo.buildApp();
+    app.route("POST", "/form")(lambda req, res: {"n": len(req.fdata)});
+    add("jsonPost", app, "POST", "/form",
+        json.dumps({"k%d" % i: i for i in range(20)}).encode(),
+        CONTENT_TYPE="application/json",
+    );
+    add("urlencodedPost", app, "POST", "/form",
+        "&".join("k%d=v%d" % (i, i) for i in range(20)).encode(),
+        CONTENT_TYPE="application/x-www-form-urlencoded",
+    );
+    boundary = "vilobenchboundary";
+    multipartBody = b"".join([
+        b"--%s\r\nContent-Disposition: form-data; name=\"title\"\r\n\r\nHello\r\n" % boundary.encode(),
+        b"--%s\r\nContent-Disposition: form-data; name=\"f\"; filename=\"a.txt\"\r\n" % boundary.encode(),
+        b"Content-Type: text/plain\r\n\r\n" + b"x" * 4096 + b"\r\n",
+        b"--%s--\r\n" % boundary.encode(),
+    ]);
+    add("multipartPost", app, "POST", "/form", multipartBody,
+        CONTENT_TYPE="multipart/form-data; boundary=%s" % boundary,
+    );
+
+    # Signed cookies:
+    app = vilo.buildApp();
+    secret = "benchmark-secret";
+    @app.route("GET", "/me")
+    def get_me (req, res):
+        userId = req.getCookie("userId", secret);
+        res.setCookie("userId", userId, secret);
+        return "User: %s" % userId;
+    signed = vilo.signWrap("user-123", secret);
+    add("signedCookie", app, "GET", "/me", HTTP_COOKIE="userId=%s" % signed);
+
+    # Static files:
+    app = vilo.buildApp();
+    staticPath = os.path.join(staticDir, "bench.txt");
+    with open(staticPath, "wb") as f:
+        f.write(b"static " * 2048);
+    app.route("GET", "/static")(lambda req, res: res.staticFile(staticPath));
+    app.mountStatic("/assets", staticDir);
+    add("staticFile", app, "GET", "/static");
+    add("mountStatic", app, "GET", "/assets/bench.txt");
+
+    # Plugin stack:
+    app = vilo.buildApp();
+    def mkPlugin (headerName):
+        def plugin (fn):
+            def wrapper (req, res, *a, **ka):
+                res.setHeader(headerName, "1");
+                return fn(req, res, *a, **ka);
+            return wrapper;
+        return plugin;
+    for i in range(5):
+        app.install(mkPlugin("X-Plugin-%d" % i));
+    app.route("GET", "/")(lambda req, res: "Plugged!");
+    add("pluginStack", app, "GET", "/");
+
+    return scenarioList;
+
+# Runners: #################################################
+
+def runThroughput (scenario, n):
+    "Returns requests/sec for `n` calls to `app.wsgi`.";
+    wsgi, mkEnv = scenario["app"].wsgi, scenario["mkEnv"];
+    envList = [mkEnv() for _ in range(n)];  # Not timed.
+    t0 = time.perf_counter();
+    for environ in envList:
+        consume(wsgi(environ, noop_start_response));
+    return n / (time.perf_counter() - t0);
+
+STAGE_LIST = [stage for (stage, end) in vilo.STAGE_END_LIST];
+
+def runStaged (scenario, n):
+    "Returns avg microseconds per stage, as timed by `app.wsgi` itself.";
+    # Via an observer (see app.addObserver), so stages are exactly
+    # app.wsgi's, incl. route settings & framework-error handlers.
+    # A stage that didn't run (eg. 'match', for a 404) is folded
+    # into the next one, see vilo.timingToStages(.)
+    app, mkEnv = scenario["app"], scenario["mkEnv"];
+    totals = dict.fromkeys(STAGE_LIST, 0.0);
+    def observe (timing):
+        for (stage, secs) in vilo.timingToStages(timing["stamps"]).items():
+            if stage in totals:
+                totals[stage] += secs;
+    app.addObserver(observe);
+    try:
+        for _ in range(n):
+            consume(app.wsgi(mkEnv(), noop_start_response));
+    finally:
+        app.removeObserver(observe);
+    return {stage: totals[stage] / n * 1e6 for stage in STAGE_LIST};
+
+# Reporting: ###############################################
+
+def compareToBaseline (resultMap, baselineMap, threshold):
+    "Returns list of (name, baseRps, rps) for regressed scenarios.";
+    regressionList = [];
+    for (name, result) in resultMap.items():
+        base = baselineMap.get(name);
+        if base and result["rps"] < base["rps"] * (1 - threshold):
+            regressionList.append((name, base["rps"], result["rps"]));
+    return regressionList;
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark vilo in-process.");
+    parser.add_argument("names", nargs="*", help="Scenarios to run (default: all).");
+    parser.add_argument("-n", type=int, default=5000, help="Requests per scenario.");
+    parser.add_argument("--save", help="Save results as baseline JSON, to path.");
+    parser.add_argument("--compare", help="Compare against baseline JSON at path.");
+    parser.add_argument("--threshold", type=float, default=0.10,
+        help="Fractional slowdown flagged as a regression (default: 0.10).",
+    );
+    args = parser.parse_args(argv);
+
+    with tempfile.TemporaryDirectory() as staticDir:
+        scenarioList = buildScenarioList(staticDir);
+        if args.names:
+            unknownList = sorted(set(args.names) - {s["name"] for s in scenarioList});
+            if unknownList:
+                parser.error("Unknown scenario(s): %s" % ", ".join(unknownList));
+            scenarioList = [s for s in scenarioList if s["name"] in args.names];
+        resultMap = {};
+        print("%-16s %12s   %s" % ("scenario", "req/sec", "  ".join(
+            "%s(us)" % stage for stage in STAGE_LIST
+        )));
+        for scenario in scenarioList:
+            runThroughput(scenario, min(args.n, 500));     # Warm up.
+            rps = runThroughput(scenario, args.n);
+            stageMap = runStaged(scenario, args.n);
+            resultMap[scenario["name"]] = {"rps": rps, "stages": stageMap};
+            print("%-16s %12.0f   %s" % (scenario["name"], rps, "  ".join(
+                ("%.2f" % stageMap[stage]).rjust(len(stage) + 4)
+                for stage in STAGE_LIST
+            )));
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(resultMap, f, indent=4);
+        print("\nSaved baseline to %s" % args.save);
+    if args.compare:
+        with open(args.compare) as f:
+            baselineMap = json.load(f);
+        regressionList = compareToBaseline(resultMap, baselineMap, args.threshold);
+        for (name, baseRps, rps) in regressionList:
+            print("REGRESSION: %s: %.0f -> %.0f req/sec (%.1f%%)" % (
+                name, baseRps, rps, (rps / baseRps - 1) * 100,
+            ));
+        if regressionList:
+            return 1;
+        print("\nNo regressions beyond %.0f%%." % (args.threshold * 100));
+    return 0;
+
+if __name__ == "__main__":
+    sys.exit(main());
+
+# End ######################################################
@@ -1,3 +1,5 @@
+import io;
+import json;
 import pprint;
 
 import dotsi;
@@ -10,6 +12,16 @@ app.setDebug(True);
 # TODO: Switch to a proper testing framework like unittest.
 # TODO: Create mini-apps and test 'em with requests.
 
+def mkEnviron (verb, path, body=b"", **extra):
+    "Makes a minimal WSGI environ, for testing.";
+    environ = {
+        "REQUEST_METHOD": verb, "PATH_INFO": path,
+        "wsgi.input": io.BytesIO(body), "wsgi.url_scheme": "http",
+        "SERVER_NAME": "localhost", "SERVER_PORT": "80",
+    };
+    environ.update(extra);
+    return environ;
+
 def test_wildcardMatch ():
     f = lambda w, a: vilo.checkWildcardMatch(w, a, dotsi.fy({}));
     assert f("/*", "/foo") is True;
@@ -46,6 +58,894 @@ def test_routeFindAndPop ():
     assert not app.findNamedRoute("pgX");
     app.route("GET", "/pgX", name="pgX")(mkH("Page X2"));
 
+def test_routeDispatch ():
+    app = vilo.buildApp();
+    mkH = lambda rv: (lambda req, res: rv);
+    f = lambda verb, path: (
+        app.getMatchingRoute(vilo.buildRequest(mkEnviron(verb, path)))
+    );
+    app.route("GET", "/foo/*")(mkH("wc"));
+    app.route("GET", "/foo/bar")(mkH("exact"));
+    app.route("GET", r"/foo/(\d+)", name="re")(mkH("re"));
+    app.route("GET", "/s/**")(mkH("s"));
+    app.route("POST", "/foo/bar")(mkH("post"));
+    assert f("GET", "/foo/bar").fn(0, 0) == "wc";   # First match wins.
+    assert f("GET", "/foo/12").fn(0, 0) == "wc";
+    assert f("POST", "/foo/bar").fn(0, 0) == "post";
+    assert f("GET", "/s/a/b").fn(0, 0) == "s";
+    app.route("GET", "/foo/bar", top=True)(mkH("top"));
+    assert f("GET", "/foo/bar").fn(0, 0) == "top";  # Rebuilt lazily.
+    app.route("GET", r"/foo/(\d+)", top=True)(mkH("reTop"));
+    assert f("GET", "/foo/12").fn(0, 0) == "reTop";
+    for (verb, path, fwCode) in [
+        ("GET", "/nope", "route_not_found"),
+        ("PUT", "/foo/bar", "method_not_allowed"),
+        ("GET", "/s/", "route_not_found"),
+    ]:
+        try:
+            f(verb, path);
+            assert False; # <-- Line must be unreachable.
+        except vilo.HttpError as e:
+            assert e._fwCode == fwCode;
+
+def test_pluginCache ():
+    app = vilo.buildApp();
+    app.route("GET", "/")(lambda req, res: "home");
+    app.route("GET", "/x")(lambda req, res: 1/0);
+    decoCount = [0];
+    def plugin_exclaim (fn):
+        decoCount[0] += 1;
+        return lambda req, res, *a: fn(req, res, *a) + "!";
+    call = lambda path: b"".join(app.wsgi(mkEnviron("GET", path), lambda *a: None));
+    app.install(plugin_exclaim);
+    assert call("/") == b"home!";
+    assert call("/") == b"home!";
+    assert decoCount[0] == 1;   # Plugged once, then cached.
+    app.install(plugin_exclaim);
+    assert call("/") == b"home!!";
+    assert decoCount[0] == 3;
+    app.frameworkError("route_not_found")(lambda req, res, err: "404");
+    assert call("/nope") == b"404";
+    app.setErrorPlugging(True);
+    assert call("/nope") == b"404!!";
+    assert call("/nope") == b"404!!";
+    assert decoCount[0] == 5;
+    assert call("/x") == b"<h2>500 Internal Server Error</h2>";
+
+def test_lazyRequest ():
+    environ = mkEnviron("POST", "/", b'{"a": 1}',
+        CONTENT_TYPE="application/json", QUERY_STRING="q=1",
+        HTTP_COOKIE="c=2",
+    );
+    req = vilo.buildRequest(environ);
+    assert environ["wsgi.input"].tell() == 0;   # Body not yet read.
+    assert req.fdata.a == 1 and req.qdata.q == "1";
+    assert req.bodyBytes == b'{"a": 1}';        # Memoized.
+    assert req.getCookie("c") == "2";
+    assert req.url == "http://localhost/?q=1";
+    req.user = "plugin-set attribute";          # Still allowed.
+    assert req.user == "plugin-set attribute";
+
+def test_responseHeaders ():
+    app = vilo.buildApp();
+    app.setDefaultHeaders({"X-Frame-Options": "DENY", "X-Team": "Café"});
+    @app.route("GET", "/")
+    def get_home (req, res):
+        res.setHeader("X-Team", "Polydojo");
+        res.setCookie("c", "1");
+        return {"ok": True};
+    out = {};
+    def start_response (statusLine, headerList):
+        out.update(statusLine=statusLine, headerMap=dict(headerList));
+    body = b"".join(app.wsgi(mkEnviron("GET", "/"), start_response));
+    assert out["statusLine"] == "200 OK";
+    assert out["headerMap"]["X-FRAME-OPTIONS"] == "DENY";
+    assert out["headerMap"]["X-TEAM"] == "Polydojo";   # Overrides default.
+    assert out["headerMap"]["SET-COOKIE"] == "c=1; HttpOnly; Path=/";
+    assert out["headerMap"]["CONTENT-TYPE"] == "application/json";
+    assert out["headerMap"]["CONTENT-LENGTH"] == str(len(body));
+    assert vilo.encodeHeaders({"x-a": "Café"}) == (("X-A", "CafÃ©"),);
+
+def test_bodyLimits ():
+    app = vilo.buildApp();
+    app.setBodyLimits(10, spoolSize=4);
+    app.route("POST", "/bytes")(lambda req, res: req.bodyBytes);
+    app.route("POST", "/big", maxBodySize=100)(lambda req, res: req.bodyBytes);
+    app.route("POST", "/file")(lambda req, res: req.bodyFile.read());
+    app.route("POST", "/stream")(
+        lambda req, res: b"|".join(req.stream(chunkSize=3)),
+    );
+    app.frameworkError("request_too_large")(lambda req, res, err: "413");
+    out = {};
+    def call (path, body, **extra):
+        environ = mkEnviron("POST", path, body, **extra);
+        start_response = lambda sl, hl: out.update(statusLine=sl);
+        return b"".join(app.wsgi(environ, start_response));
+    assert call("/bytes", b"0123456789") == b"0123456789";
+    assert call("/bytes", b"0123456789X") == b"413";
+    assert out["statusLine"] == "413 Payload Too Large";
+    assert call("/big", b"0123456789X") == b"0123456789X";
+    assert call("/stream", b"0123456") == b"012|345|6";
+    assert call("/file", b"0123456789") == b"0123456789"; # Spooled.
+    # Early rejection, based on Content-Length, before any reading:
+    environ = mkEnviron("POST", "/bytes", b"x" * 50, CONTENT_LENGTH="50");
+    assert b"".join(app.wsgi(environ, lambda *a: None)) == b"413";
+    assert environ["wsgi.input"].tell() == 0;
+
+def test_multipart ():
+    app = vilo.buildApp();
+    app.setBodyLimits(1000, spoolSize=8, maxPartSize=100);
+    @app.route("POST", "/")
+    def post_upload (req, res):
+        small, big = req.fdata.small, req.fdata.big;
+        return {
+            "title": req.fdata.title,
+            "small": [small.filename, small.mimeType, small.bytes.decode()],
+            "big": [big.bytes, big.file.read().decode()],   # Spilled.
+        };
+    app.frameworkError("request_too_large")(lambda req, res, err: "413");
+    body = b"\r\n".join([
+        b"--XyZ", b'Content-Disposition: form-data; name="title"', b"",
+        b"Hello, World!",
+        b"--XyZ", b'Content-Disposition: form-data; name="small"; filename="s.txt"',
+        b"Content-Type: text/plain", b"", b"tiny",
+        b"--XyZ", b'Content-Disposition: form-data; name="big"; filename="b.txt"',
+        b"", b"0123456789" * 5,
+        b"--XyZ--", b"",
+    ]);
+    call = lambda body: b"".join(app.wsgi(mkEnviron("POST", "/", body,
+        CONTENT_TYPE="multipart/form-data; boundary=XyZ",
+    ), lambda *a: None));
+    assert json.loads(call(body)) == {
+        "title": "Hello, World!",
+        "small": ["s.txt", "text/plain", "tiny"],
+        "big": [None, "0123456789" * 5],
+    };
+    assert call(body.replace(b"0123456789", b"0123456789" * 3)) == b"413";
+
+def test_streamedResponse ():
+    app = vilo.buildApp();
+    closed = [];
+    @app.route("GET", "/export.csv")
+    def get_export (req, res):
+        res.contentType = "text/csv";
+        def gen ():
+            try:
+                yield "id,name\n";
+                for i in range(3):
+                    yield b"%d,item%d\n" % (i, i);
+            finally:
+                closed.append(True);
+        return gen();
+    @app.route("GET", "/sized")
+    def get_sized (req, res):
+        res.setHeader("Content-Length", 6);
+        return iter([b"foo", "bar"]);
+    out = {};
+    start_response = lambda sl, hl: out.update(headerMap=dict(hl));
+    body = app.wsgi(mkEnviron("GET", "/export.csv"), start_response);
+    assert "CONTENT-LENGTH" not in out["headerMap"];
+    assert b"".join(body) == b"id,name\n0,item0\n1,item1\n2,item2\n";
+    body.close();
+    assert closed == [True];
+    body = app.wsgi(mkEnviron("GET", "/sized"), start_response);
+    assert out["headerMap"]["CONTENT-LENGTH"] == "6";
+    assert b"".join(body) == b"foobar";
+    app.route("GET", "/ints")(lambda req, res: iter([bytearray(b"ok"), 1, 2]));
+    body = app.wsgi(mkEnviron("GET", "/ints"), start_response);
+    try:
+        b"".join(body);
+        assert False;   # Unreachable, ints aren't chunks.
+    except TypeError:
+        pass;
+
+def test_staticFile ():
+    import tempfile, wsgiref.util;
+    app = vilo.buildApp();
+    tmpdir = tempfile.mkdtemp();
+    with open(tmpdir + "/hello.txt", "wb") as f:
+        f.write(b"Hello, World!");
+    app.route("GET", "/**")(
+        lambda req, res: res.staticFile(tmpdir + "/" + req.wildcards[0]),
+    );
+    out = {};
+    def call (path, **extra):
+        environ = mkEnviron("GET", path, **extra);
+        start_response = lambda sl, hl: out.update(statusLine=sl, headerMap=dict(hl));
+        body = app.wsgi(environ, start_response);
+        out["body"] = b"".join(body);
+        getattr(body, "close", lambda: None)();
+        return body;
+    body = call("/hello.txt", **{"wsgi.file_wrapper": wsgiref.util.FileWrapper});
+    assert type(body) is wsgiref.util.FileWrapper;
+    assert out["body"] == b"Hello, World!";
+    assert out["headerMap"]["CONTENT-TYPE"] == "text/plain";
+    assert out["headerMap"]["CONTENT-LENGTH"] == "13";
+    etag = out["headerMap"]["ETAG"];
+    lastModified = out["headerMap"]["LAST-MODIFIED"];
+    call("/hello.txt", HTTP_IF_NONE_MATCH=etag);
+    assert out["statusLine"] == "304 Not Modified" and out["body"] == b"";
+    assert "CONTENT-LENGTH" not in out["headerMap"];
+    call("/hello.txt", HTTP_IF_MODIFIED_SINCE=lastModified);
+    assert out["statusLine"] == "304 Not Modified";
+    call("/hello.txt", HTTP_RANGE="bytes=7-");
+    assert out["statusLine"] == "206 Partial Content";
+    assert out["body"] == b"World!";
+    assert out["headerMap"]["CONTENT-RANGE"] == "bytes 7-12/13";
+    call("/hello.txt", HTTP_RANGE="bytes=-6", HTTP_IF_RANGE='"stale"');
+    assert out["statusLine"] == "200 OK";   # If-Range mismatch, full.
+    call("/hello.txt", HTTP_RANGE="bytes=99-");
+    assert out["statusLine"] == "416 Range Not Satisfiable";
+    call("/no-such-file.txt");
+    assert out["statusLine"] == "404 Not Found";
+
+def test_mountStatic ():
+    import tempfile, gzip;
+    app = vilo.buildApp();
+    tmpdir = tempfile.mkdtemp();
+    with open(tmpdir + "/app.js", "wb") as f:
+        f.write(b"alert(1);");
+    with open(tmpdir + "/app.js.gz", "wb") as f:
+        f.write(gzip.compress(b"alert(1);"));
+    with open(tmpdir + "/.env", "wb") as f:
+        f.write(b"SECRET=1");
+    app.mountStatic("/static/", tmpdir, memCacheSize=10);
+    app.frameworkError("file_not_found")(lambda req, res, err: "404");
+    out = {};
+    def call (path, **extra):
+        start_response = lambda sl, hl: out.update(statusLine=sl, headerMap=dict(hl));
+        return b"".join(app.wsgi(mkEnviron("GET", path, **extra), start_response));
+    assert call("/static/app.js") == b"alert(1);";
+    assert out["headerMap"]["VARY"] == "Accept-Encoding";
+    assert "CONTENT-ENCODING" not in out["headerMap"];
+    body = call("/static/app.js", HTTP_ACCEPT_ENCODING="br;q=1, gzip");
+    assert gzip.decompress(body) == b"alert(1);";
+    assert out["headerMap"]["CONTENT-ENCODING"] == "gzip";
+    assert out["headerMap"]["CONTENT-TYPE"] == "text/javascript";
+    call("/static/app.js", HTTP_IF_NONE_MATCH=out["headerMap"]["ETAG"],
+        HTTP_ACCEPT_ENCODING="gzip",
+    );
+    assert out["statusLine"] == "304 Not Modified";
+    assert call("/static/.env") == b"404";      # Hidden, not listed.
+    assert call("/static/../tests.py") == b"404";
+    with open(tmpdir + "/app.css", "wb") as f:
+        f.write(b"body { color: red; }" * 100);
+    app = vilo.buildApp();
+    app.setCompression(True, minSize=0);
+    app.mountStatic("/static/", tmpdir, memCacheSize=10);
+    call("/static/app.css", HTTP_ACCEPT_ENCODING="gzip");     # Warms memCache.
+    assert call("/static/app.css", HTTP_ACCEPT_ENCODING="gzip").startswith(b"body");
+    assert "CONTENT-ENCODING" not in out["headerMap"];      # Not on the fly.
+
+def test_compression ():
+    import gzip, zlib;
+    app = vilo.buildApp();
+    app.setCompression(level=9, minSize=100);
+    bigJson = {"items": list(range(200))};
+    app.route("GET", "/json")(lambda req, res: bigJson);
+    app.route("GET", "/tiny")(lambda req, res: "tiny");
+    app.route("GET", "/off", compress=False)(lambda req, res: bigJson);
+    app.route("GET", "/png")(lambda req, res: (
+        setattr(res, "contentType", "image/png") or b"x" * 500
+    ));
+    app.route("GET", "/ndjson")(lambda req, res: (
+        '{"i": %d}\n' % i for i in range(100)
+    ));
+    out = {};
+    def call (path, acceptEncoding="gzip, deflate"):
+        environ = mkEnviron("GET", path, HTTP_ACCEPT_ENCODING=acceptEncoding);
+        start_response = lambda sl, hl: out.update(headerMap=dict(hl));
+        return b"".join(app.wsgi(environ, start_response));
+    body = call("/json");
+    assert json.loads(gzip.decompress(body)) == bigJson;
+    assert out["headerMap"]["CONTENT-ENCODING"] == "gzip";
+    assert out["headerMap"]["VARY"] == "Accept-Encoding";
+    assert out["headerMap"]["CONTENT-LENGTH"] == str(len(body));
+    assert json.loads(zlib.decompress(call("/json", "deflate"))) == bigJson;
+    assert json.loads(call("/json", "gzip;q=0")) == bigJson;
+    for path in ["/tiny", "/off", "/png"]:
+        call(path);
+        assert "CONTENT-ENCODING" not in out["headerMap"];
+    body = call("/ndjson");
+    assert gzip.decompress(body).count(b"\n") == 100;
+    assert "CONTENT-LENGTH" not in out["headerMap"];
+
+def test_responseCache ():
+    import threading, time;
+    app = vilo.buildApp();
+    callCount = [0];
+    @app.route("GET", "/report", name="report", cache={"ttl": 0.2, "query": ["page"]})
+    def get_report (req, res):
+        callCount[0] += 1;
+        time.sleep(0.05);
+        return {"page": req.qdata.get("page"), "n": callCount[0]};
+    call = lambda qs: json.loads(b"".join(app.wsgi(
+        mkEnviron("GET", "/report", QUERY_STRING=qs), lambda *a: None,
+    )));
+    threadList = [
+        threading.Thread(target=call, args=("page=1&junk=%d" % i,))
+        for i in range(5)
+    ];
+    [t.start() for t in threadList];
+    [t.join() for t in threadList];
+    assert callCount[0] == 1;   # Single-flight, and `junk` isn't keyed.
+    assert call("page=1") == {"page": "1", "n": 1};
+    assert call("page=2") == {"page": "2", "n": 2};
+    stats = app.responseCache.getStats();
+    assert stats["entries"] == 2 and stats["hits"] >= 5;
+    assert app.responseCache.invalidateRoute("report") == 2;
+    assert call("page=1")["n"] == 3;
+    time.sleep(0.25);
+    assert call("page=1")["n"] == 4;    # Expired, re-run.
+    assert app.responseCache.getStats()["expirations"] == 1;
+    # Conditional requests, on cache hits:
+    app.route("GET", "/etagged", cache=60, etag=True)(lambda req, res: "Etagged!");
+    captured = {};
+    def condCall (**extra):
+        def start_response (statusLine, headerList):
+            captured.update(dict(headerList), status=statusLine);
+        captured.clear();
+        return b"".join(app.wsgi(mkEnviron("GET", "/etagged", **extra), start_response));
+    assert condCall() == b"Etagged!";
+    etag = captured["ETAG"];
+    hits = app.responseCache.getStats()["hits"];
+    assert condCall(HTTP_IF_NONE_MATCH=etag) == b"";    # Hit, 304.
+    assert app.responseCache.getStats()["hits"] == hits + 1;
+    assert captured["status"].startswith("304") and "CONTENT-LENGTH" not in captured;
+    assert captured["ETAG"] == etag;
+    assert condCall(HTTP_IF_NONE_MATCH='"other"') == b"Etagged!";
+    # Plugins (eg. auth) run on every request, cache hits included:
+    def plugin_auth (fn):
+        def wrapper (req, res, *args, **kwargs):
+            if not req.getHeader("Authorization"):
+                raise vilo.HttpError("Unauthorized", 401);
+            return fn(req, res, *args, **kwargs);
+        return wrapper;
+    app.install(plugin_auth);
+    app.route("GET", "/secret", cache=60)(lambda req, res: "SECRET");
+    secretCall = lambda **extra: b"".join(app.wsgi(
+        mkEnviron("GET", "/secret", **extra), lambda *a: None,
+    ));
+    assert secretCall(HTTP_AUTHORIZATION="Bearer x") == b"SECRET";
+    hits = app.responseCache.getStats()["hits"];
+    assert secretCall() == b"Unauthorized";
+    assert secretCall(HTTP_AUTHORIZATION="Bearer x") == b"SECRET";
+    assert app.responseCache.getStats()["hits"] == hits + 1;
+
+def test_asgi ():
+    import asyncio;
+    app = vilo.buildApp();
+    @app.route("POST", "/echo/*")
+    def post_echo (req, res):
+        return {"name": req.wildcards[0], "body": req.bodyBytes.decode(), "q": req.qdata.q};
+    @app.route("POST", "/async")
+    async def post_async (req, res):
+        await asyncio.sleep(0);
+        return {"body": req.bodyBytes.decode()};
+    @app.route("GET", "/ticks")
+    async def get_ticks (req, res):
+        for i in range(3):
+            yield "tick%d;" % i;
+    async def call (verb, path, chunks=(), qs=b""):
+        inbox = [{"type": "http.request", "body": c, "more_body": True} for c in chunks];
+        inbox.append({"type": "http.request", "body": b""});
+        sent = [];
+        async def receive ():
+            return inbox.pop(0);
+        async def send (message):
+            sent.append(message);
+        scope = {
+            "type": "http", "method": verb, "path": path, "query_string": qs,
+            "headers": [(b"content-type", b"text/plain"), (b"x-a", b"1")],
+        };
+        await app.asgi(scope, receive, send);
+        assert sent[0]["type"] == "http.response.start";
+        body = b"".join(m.get("body", b"") for m in sent[1:]);
+        return sent[0]["status"], dict(sent[0]["headers"]), body;
+    run = lambda *a, **k: asyncio.run(call(*a, **k));
+    status, headers, body = run("POST", "/echo/caf\u00e9", [b"ab", b"cd"], b"q=1");
+    assert status == 200 and headers[b"content-type"].startswith(b"application/json");
+    assert json.loads(body) == {"name": "caf\u00e9", "body": "abcd", "q": "1"};
+    assert json.loads(run("POST", "/async", [b"xy"])[2]) == {"body": "xy"};
+    assert run("GET", "/ticks")[2] == b"tick0;tick1;tick2;";
+    assert run("GET", "/nope")[0] == 404;
+    # Sync handlers are dispatched once, not re-matched in a thread:
+    origDispatch, dispatchCount = vilo.dispatchRoute, [0];
+    def countingDispatch (*args):
+        dispatchCount[0] += 1;
+        return origDispatch(*args);
+    vilo.dispatchRoute = countingDispatch;
+    try:
+        assert json.loads(run("POST", "/echo/x", [b"ab"], b"q=2")[2])["q"] == "2";
+    finally:
+        vilo.dispatchRoute = origDispatch;
+    assert dispatchCount[0] == 1;
+    app.setAsgiThreads(2);      # After first use, rebuilds the executor.
+    assert json.loads(run("POST", "/echo/y", [b"ab"], b"q=3")[2])["name"] == "y";
+    # Async handlers aren't supported via WSGI:
+    statusList = [];
+    app.wsgi(mkEnviron("POST", "/async"), lambda s, h: statusList.append(s));
+    assert statusList[0].startswith("500");
+    b"".join(app.wsgi(mkEnviron("GET", "/ticks"), lambda s, h: statusList.append(s)));
+    assert statusList[1].startswith("500");     # Async generator, before any 200.
+
+def test_signer ():
+    old = vilo.buildSigner("s1");
+    new = vilo.buildSigner(["s2", "s1"]);
+    fast = vilo.buildSigner("s2", digest="blake2b");
+    assert fast.unwrap(fast.wrap("f")) == "f";
+    assert new.unwrap(fast.wrap("f")) is None;      # Digest mismatch.
+    oldSigned, newSigned = old.wrap({"a": 1}), new.wrap([1, "x"]);
+    assert vilo.signUnwrap(oldSigned, "s1") == {"a": 1};    # Compatible.
+    assert new.unwrap(oldSigned) == {"a": 1};               # Rotated.
+    assert new.unwrap(newSigned) == [1, "x"];
+    assert old.unwrap(newSigned) is None;
+    assert new.unwrap(newSigned.replace("@|", "@|x")) is None;  # Tampered.
+    assert new.unwrap("bad@|sig") is None;
+    value = new.unwrap(oldSigned);
+    value["a"] = 2;     # Mutating result doesn't taint cache.
+    assert new.unwrap(oldSigned) == {"a": 1};
+    assert new.getStats() == {"hits": 2, "misses": 2, "entries": 2};
+    environ = mkEnviron("GET", "/", HTTP_COOKIE="u=%s" % newSigned);
+    req = vilo.buildRequest(environ);
+    assert req.getCookie("u", new) == [1, "x"];
+    assert req.getCookie("u", ["s2"]) == [1, "x"];
+    assert req.getCookie("u", "s1") is None;
+
+def test_jsonCodec ():
+    import datetime;
+    app = vilo.buildApp();
+    @app.route("POST", "/echo")
+    def post_echo (req, res):
+        return {"in": req.fdata, "at": datetime.date(2020, 1, 2)};
+    @app.route("POST", "/raw", decodeBody=False)
+    def post_raw (req, res):
+        return {"fdata": req.fdata, "n": len(req.bodyBytes)};
+    def call (path, body):
+        statusList = [];
+        out = b"".join(app.wsgi(mkEnviron(
+            "POST", path, body, CONTENT_TYPE="application/json",
+            CONTENT_LENGTH=str(len(body)),
+        ), lambda s, h: statusList.append(s)));
+        return statusList[0][:3], out;
+    app.setJsonCodec(default=lambda x: x.isoformat());
+    assert call("/echo", b'{"a": 1}') == ("200", b'{"in": {"a": 1}, "at": "2020-01-02"}');
+    assert call("/echo", b'{bad')[0] == "400";
+    assert json.loads(call("/raw", b'{bad')[1]) == {"fdata": {}, "n": 4};
+    app.setJsonCodec(vilo.buildJsonCodec(
+        dumps=lambda x, default: json.dumps(x, default=default, separators=(",", ":")),
+        loads=json.loads, default=str,
+    ));
+    assert call("/echo", b'[1]')[1] == b'{"in":[1],"at":"2020-01-02"}';
+    codec = vilo.detectJsonCodec();     # orjson, else stdlib.
+    assert codec.decode(codec.encode({"x": [1]})) == {"x": [1]};
+
+def test_instrumentation ():
+    app = vilo.buildApp();
+    app.route("GET", "/hi", name="hi")(lambda req, res: "Hi!");
+    call = lambda path: app.wsgi(mkEnviron("GET", path), lambda s, h: headerList.extend(h));
+    headerList = [];
+    call("/hi");
+    assert "SERVER-TIMING" not in dict(headerList);    # Off by default.
+    timingList = [];
+    hist = vilo.buildStageHistogram();
+    app.addObserver(timingList.append);
+    app.addObserver(hist.observe);
+    app.setServerTiming(True);
+    call("/hi"); call("/hi"); call("/nope");
+    timing = timingList[0];
+    assert timing["route"] == "hi" and timing["status"] == 200;
+    assert timing["bodySize"] == 3 and timing["verb"] == "GET";
+    stamps = timing["stamps"];
+    keyList = ["start", "built", "matched", "plugged", "handled", "finished"];
+    assert sorted(stamps, key=stamps.get) == keyList;
+    assert timingList[2]["route"] is None and timingList[2]["status"] == 404;
+    assert dict(headerList)["SERVER-TIMING"].startswith("build;dur=");
+    histDict = hist.getDict();
+    assert histDict["hi"]["handler"]["count"] == 2;
+    assert histDict["(unmatched)"]["total"]["count"] == 1;
+    assert "hi" in hist.dumpText();
+    app.removeObserver(timingList.append);
+    call("/hi");
+    assert len(timingList) == 3 and hist.getDict()["hi"]["total"]["count"] == 3;
+    # Cache hits are stamped & timed too:
+    app.route("GET", "/cached", cache=60)(lambda req, res: "Cached!");
+    call("/cached");
+    app.addObserver(timingList.append);
+    headerList.clear();
+    b"".join(call("/cached"));
+    assert app.responseCache.getStats()["hits"] == 1;
+    assert sorted(timingList[-1]["stamps"], key=timingList[-1]["stamps"].get) == keyList;
+    assert dict(headerList)["SERVER-TIMING"].startswith("build;dur=");
+
+def test_reRoutes ():
+    app = vilo.buildApp();
+    app.route("GET", r"/post/(\d+)")(lambda req, res: "post:" + req.matched.group(1));
+    app.route("GET", r"/item/(\d+)", fullMatch=True)(lambda req, res: "item");
+    app.route("GET", r"/user/(?P<uid>\w+)")(lambda req, res: "user:" + req.matched.group("uid"));
+    app.route("GET", r"/tag/(?P<uid>\w+)")(lambda req, res: "tag:" + req.matched["uid"]);
+    app.route("GET", r"(?i)/CASE/(\d)")(lambda req, res: "case");
+    app.route("GET", r"/(\w+)/(\d+)")(lambda req, res: "any:%s:%s" % req.matched.groups());
+    def call (path):
+        statusList = [];
+        out = b"".join(app.wsgi(mkEnviron("GET", path), lambda s, h: statusList.append(s)));
+        return out.decode() if statusList[0].startswith("200") else statusList[0][:3];
+    assert call("/post/12") == "post:12";
+    assert call("/post/12/extra") == "post:12";     # Prefix match, by default.
+    assert call("/item/7") == "item";
+    assert call("/item/7/extra") == "any:item:7";   # Full match, falls through.
+    assert call("/user/ann") == "user:ann";
+    assert call("/tag/x") == "tag:x";               # Same group name, separate alternation.
+    assert call("/case/1") == "case";               # Global flags, not merged.
+    assert call("/foo/3") == "any:foo:3";
+    route = app.routeList[0];
+    assert route._rex.pattern == r"/post/(\d+)";    # Compiled once.
+    reGroupList = vilo.buildReGroupList(list(enumerate(app.routeList)));
+    assert [len(g.get("groupMap") or [0]) for g in reGroupList] == [3, 1, 1, 1];
+
+def test_urlFor ():
+    app = vilo.buildApp();
+    noop = lambda req, res: "";
+    for i in range(2000):   # Quick, as names are indexed.
+        app.addRoute("GET", "/gen/%d" % i, noop, name="gen%d" % i);
+    app.route("GET", "/", name="home")(noop);
+    app.route("GET", "/user/*/post/*", name="post")(noop);
+    app.route("GET", "/files/**", name="files")(noop);
+    app.route("GET", r"^/from-(\d+)-to-(?P<y>\d+)\.html$", name="range")(noop);
+    app.route("GET", r"/x/(\d+)+", name="bad")(noop);
+    assert app.findNamedRoute("gen1999").path == "/gen/1999";
+    assert app.urlFor("home", q="a b", tag=["x", "y"]) == "/?q=a+b&tag=x&tag=y";
+    assert app.urlFor("post", "ann/b", 12) == "/user/ann%2Fb/post/12";
+    assert app.urlFor("files", "a/b c.txt") == "/files/a/b%20c.txt";
+    assert app.urlFor("range", 2018, 2020) == "/from-2018-to-2020.html";
+    for (name, args) in [("post", (1,)), ("bad", (1,)), ("nope", ())]:
+        try:
+            app.urlFor(name, *args);
+            assert False;
+        except ValueError:
+            pass;
+    app.popNamedRoute("post");
+    assert app.findNamedRoute("post") is None;
+    app.route("GET", "/p/*", name="post")(noop);    # Name is reusable.
+    assert app.urlFor("post", 1) == "/p/1";
+    app.routeList.pop(0);   # Direct modification, then reset:
+    app.resetRouteCache();
+    assert app.findNamedRoute("gen0") is None;
+
+def test_serve ():
+    import os, signal, socket, time, urllib.request;
+    app = vilo.buildApp();
+    app.route("GET", "/pid")(lambda req, res: "%s:%s" % (os.getpid(), res.app.warm));
+    app.warm = False;
+    sock = socket.socket();
+    sock.bind(("127.0.0.1", 0));
+    port = sock.getsockname()[1];
+    sock.close();
+    def onWorkerStart (wApp):
+        wApp.warm = True;
+    masterPid = os.fork();
+    if masterPid == 0:
+        try:
+            vilo.serve(app, port=port, workers=2, maxRequests=2, onWorkerStart=onWorkerStart);
+        finally:
+            os._exit(0);
+    try:
+        url = "http://127.0.0.1:%d/pid" % port;
+        for _ in range(50):
+            try:
+                urllib.request.urlopen(url, timeout=2).read();
+                break;
+            except OSError:
+                time.sleep(0.1);
+        outList = [urllib.request.urlopen(url, timeout=5).read().decode() for _ in range(10)];
+        assert all(out.endswith(":True") for out in outList);
+        assert len(set(outList)) >= 3;  # Workers were recycled.
+    finally:
+        os.kill(masterPid, signal.SIGTERM);
+        assert os.waitpid(masterPid, 0)[1] == 0;    # Graceful exit.
+
+def test_escfmt ():
+    assert vilo.esc("""<a href='x'>"&"</a>""") == "&lt;a href=&#039;x&#039;&gt;&quot;&amp;&quot;&lt;/a&gt;";
+    assert vilo.esc(12) == "12" and vilo.esc(None) == "None" and vilo.esc([1, "<"]) == "[1, &#039;&lt;&#039;]";
+    assert vilo.escfmt("<b>%s</b>", "<i>") == "<b>&lt;i&gt;</b>";
+    class Tag (str): pass;
+    assert vilo.compileEscfmt("<b>%s</b>").render(Tag("<i>")) == "<b>&lt;i&gt;</b>";
+    assert vilo.escfmt("%s-%s", [1, "&"]) == "1-&amp;";
+    assert vilo.escfmt("%(a)s %(b)s %%(c)s", {"a": "<", "b": 2, "c": "unused"}) == "&lt; 2 %(c)s";
+    for (string, seq) in [("<b>%s</b>", {"a": "<"}), ("%(a)s", {"a": "&", "b": 1})]:
+        assert vilo.compileEscfmt(string).render(seq) == vilo.escfmt(string, seq);
+    tpl = vilo.compileEscfmt("<td>%s</td><td>%s</td>");
+    assert vilo.compileEscfmt("<td>%s</td><td>%s</td>") is tpl;     # Cached.
+    rows = [("a", 1), ["<", 2], ("&", None)] * 3;
+    assert tpl.renderChunks(rows)[1] == "<td>&lt;</td><td>2</td>";
+    assert tpl.renderRows(rows) == "".join(vilo.escfmt(tpl.string, r) for r in rows);
+    chunkList = list(tpl.iterRows(iter(rows), batchSize=4));
+    assert len(chunkList) == 3 and "".join(chunkList) == tpl.renderRows(rows);
+
+def test_defer ():
+    import threading, time;
+    app = vilo.buildApp();
+    doneList, errList = [], [];
+    app.setDeferPool(threads=1, maxQueue=10, overflow="drop",
+        onError=lambda err, fn: errList.append(type(err).__name__),
+    );
+    @app.route("GET", "/hi")
+    def get_hi (req, res):
+        res.defer(doneList.append, "a");
+        res.defer(lambda: 1/0);
+        return "Hi!";
+    body = app.wsgi(mkEnviron("GET", "/hi"), lambda s, h: None);
+    assert b"".join(body) == b"Hi!" and doneList == [];     # Not yet.
+    body.close();
+    assert app.deferPool.wait(5);
+    assert doneList == ["a"] and errList == ["ZeroDivisionError"];
+    # Overflow policies, with a single busy thread & 1-slot queue:
+    gate = threading.Event();
+    for (policy, expected) in [("drop", ["OverflowError"]), ("inline", ["x"])]:
+        doneList.clear(); errList.clear(); gate.clear();
+        app.setDeferPool(threads=1, maxQueue=1, overflow=policy,
+            onError=lambda err, fn: errList.append(type(err).__name__),
+        );
+        pool = app.deferPool;
+        assert pool.submit(gate.wait);          # Occupies thread.
+        time.sleep(0.05);
+        assert pool.submit(doneList.append, ("queued",));  # Fills queue.
+        assert pool.submit(doneList.append, ("x",)) == (policy != "drop");
+        assert (errList if policy == "drop" else doneList) == expected;
+        gate.set();
+        assert pool.wait(5);
+        assert doneList[-1] == "queued";
+    assert pool.getStats()["inlined"] == 1;
+
+def test_admission ():
+    import threading;
+    app = vilo.buildApp();
+    gate, entered = threading.Event(), threading.Event();
+    @app.route("GET", "/slow", name="slow", maxInFlight=1)
+    def get_slow (req, res):
+        entered.set();
+        gate.wait(5);
+        return "Slow!";
+    app.route("GET", "/fast")(lambda req, res: "Fast!");
+    statusList = [];
+    def call (path, **extra):
+        body = app.wsgi(mkEnviron("GET", path, **extra),
+            lambda s, h: statusList.append((s, dict(h))),
+        );
+        out = b"".join(body);
+        if hasattr(body, "close"): body.close();
+        return out;
+    # Per-route cap: 2nd concurrent request is shed, with 503:
+    t = threading.Thread(target=call, args=("/slow",));
+    t.start();
+    assert entered.wait(5);
+    assert b"Service overloaded." in call("/slow");
+    assert statusList[-1][0].startswith("503");
+    assert statusList[-1][1]["RETRY-AFTER"] == "1";
+    assert call("/fast") == b"Fast!";    # Other routes unaffected.
+    gate.set(); t.join();
+    assert call("/slow") == b"Slow!";    # Slot released.
+    stats = app.getAdmissionStats()["routes"]["slow"];
+    assert stats["inFlight"] == 0 and stats["admitted"] == 2 and stats["rejected"] == 1;
+    # App-wide cap, with queue wait:
+    app.setConcurrencyLimit(1, queueTimeout=5);
+    gate.clear(); entered.clear();
+    t = threading.Thread(target=call, args=("/slow",));
+    t.start();
+    assert entered.wait(5);
+    threading.Timer(0.05, gate.set).start();
+    assert call("/fast") == b"Fast!";    # Waited for slot.
+    t.join();
+    assert app.getAdmissionStats()["app"]["queued"] == 1;
+    app.setConcurrencyLimit(None);
+    # Per-client rate limit, 429:
+    app.setRateLimit(rate=1, burst=2);
+    assert call("/fast") == call("/fast") == b"Fast!";
+    assert b"Too many requests." in call("/fast");
+    assert statusList[-1][0].startswith("429");
+    assert call("/fast", REMOTE_ADDR="10.0.0.2") == b"Fast!";
+    assert app.getAdmissionStats()["rate"] == {"allowed": 3, "limited": 1, "clients": 2};
+    call("/nope", REMOTE_ADDR="10.0.0.3");
+    call("/nope", REMOTE_ADDR="10.0.0.3");
+    assert statusList[-1][0].startswith("404");
+    call("/nope", REMOTE_ADDR="10.0.0.3");
+    assert statusList[-1][0].startswith("429");     # 404s are limited too.
+    app.setRateLimit(None);
+    # Slots are released even if finishing the response fails:
+    class Unprintable (object):
+        def __str__ (self): raise ValueError("Unprintable!");
+    app.route("GET", "/bad", name="bad", maxInFlight=1)(lambda req, res: Unprintable());
+    for i in range(2):
+        try:
+            call("/bad");
+            assert False;   # Unreachable.
+        except ValueError:
+            pass;
+    stats = app.getAdmissionStats()["routes"]["bad"];
+    assert stats["inFlight"] == 0 and stats["rejected"] == 0;
+
+def test_sessions ():
+    import os, tempfile;
+    with tempfile.TemporaryDirectory() as tmpDir:
+        for store in [
+            vilo.buildMemorySessionStore(maxCount=2),
+            vilo.buildSqliteSessionStore(os.path.join(tmpDir, "sessions.db")),
+        ]:
+            app = vilo.buildApp();
+            app.setSessions(store, "session-secret");
+            @app.route("GET", "/visit")
+            def get_visit (req, res):
+                req.session["n"] = req.session.get("n", 0) + 1;
+                return "Visits: %s" % req.session["n"];
+            app.route("GET", "/peek")(lambda req, res: "Peek: %s" % req.session.get("n"));
+            app.route("GET", "/login")(lambda req, res: req.session.regenerate() or "In");
+            app.route("GET", "/logout")(lambda req, res: req.session.invalidate() or "Out");
+            app.route("GET", "/none")(lambda req, res: "None");
+            captured = {};
+            def call (path, cookie=None):
+                extra = {"HTTP_COOKIE": "vilo_session=" + cookie} if cookie else {};
+                captured.clear();
+                body = app.wsgi(mkEnviron("GET", path, **extra),
+                    lambda s, h: captured.update(h),
+                );
+                return b"".join(body);
+            def getCookie ():
+                return captured["SET-COOKIE"].split(";")[0].split("=", 1)[1];
+            assert call("/visit") == b"Visits: 1";
+            cookie = getCookie();
+            assert len(cookie) < 200;       # Only a signed ID.
+            assert call("/visit", cookie) == b"Visits: 2";
+            assert "SET-COOKIE" not in captured;    # Same ID, no new cookie.
+            assert call("/peek", cookie) == b"Peek: 2";
+            assert call("/peek", cookie + "x") == b"Peek: None";    # Bad sig.
+            assert call("/none", cookie) == b"None";    # Never loaded.
+            assert call("/login", cookie) == b"In";
+            newCookie = getCookie();
+            assert newCookie != cookie;
+            assert call("/peek", cookie) == b"Peek: None";
+            assert call("/peek", newCookie) == b"Peek: 2";
+            # Cached routes still save sessions, but aren't cached if they write:
+            @app.route("GET", "/cachedVisit", cache=60)
+            def get_cachedVisit (req, res):
+                req.session["n"] = req.session.get("n", 0) + 1;
+                return "Cached: %s" % req.session["n"];
+            assert call("/cachedVisit", newCookie) == b"Cached: 3";
+            assert call("/peek", newCookie) == b"Peek: 3";
+            assert call("/cachedVisit", newCookie) == b"Cached: 4";
+            assert app.responseCache.getStats()["entries"] == 0;
+            assert call("/logout", newCookie) == b"Out";
+            assert "max-age=0" in captured["SET-COOKIE"].lower();
+            assert call("/peek", newCookie) == b"Peek: None";
+            assert store.getStats()["sessions"] == 0;
+    app = vilo.buildApp();
+    app.route("GET", "/")(lambda req, res: req.session);
+    assert b"500" in b"".join(app.wsgi(mkEnviron("GET", "/"), lambda s, h: None));
+
+def test_etags ():
+    app = vilo.buildApp();
+    app.setAutoEtag("weak");
+    renderCount = {"n": 0};
+    @app.route("GET", "/stats")
+    def get_stats (req, res):
+        return {"cpu": 42};
+    @app.route("GET", "/report")
+    def get_report (req, res):
+        if res.setEtag("version-7"):
+            return "";      # Skips rendering.
+        renderCount["n"] += 1;
+        return "Report!";
+    app.route("GET", "/raw", etag=False)(lambda req, res: "Raw");
+    app.route("GET", "/strict", etag="strong")(lambda req, res: "Strict");
+    captured = {};
+    def call (path, **extra):
+        def start_response (statusLine, headerList):
+            captured.update(dict(headerList), status=statusLine);
+        captured.clear();
+        return b"".join(app.wsgi(mkEnviron("GET", path, **extra), start_response));
+    assert call("/stats") == b'{"cpu": 42}';
+    etag = captured["ETAG"];
+    assert etag.startswith('W/"') and captured["status"].startswith("200");
+    assert call("/stats", HTTP_IF_NONE_MATCH=etag) == b"";
+    assert captured["status"].startswith("304") and "CONTENT-LENGTH" not in captured;
+    assert call("/stats", HTTP_IF_NONE_MATCH='"other"') == b'{"cpu": 42}';
+    # Handler-supplied version key, short-circuits work:
+    assert call("/report") == b"Report!" and renderCount["n"] == 1;
+    assert call("/report", HTTP_IF_NONE_MATCH=captured["ETAG"]) == b"";
+    assert captured["status"].startswith("304") and renderCount["n"] == 1;
+    # Per-route modes:
+    call("/raw");
+    assert "ETAG" not in captured;
+    call("/strict");
+    assert captured["ETAG"].startswith('"');
+    # Compressed (on the fly) => weakened, still matchable:
+    app.setCompression(True, minSize=0);
+    app.route("GET", "/big", etag="strong")(lambda req, res: "Big! " * 100);
+    call("/big");
+    strongEtag = captured["ETAG"];
+    call("/big", HTTP_ACCEPT_ENCODING="gzip");
+    assert captured["CONTENT-ENCODING"] == "gzip" and captured["ETAG"] == "W/" + strongEtag;
+    call("/big", HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=captured["ETAG"]);
+    assert captured["status"].startswith("304") and "CONTENT-ENCODING" not in captured;
+    # Unsafe verbs get 412, not 304:
+    @app.route("PUT", "/doc")
+    def put_doc (req, res):
+        if res.setEtag("doc-v1"):
+            return "";
+        return "Saved!";
+    body = b"".join(app.wsgi(mkEnviron("PUT", "/doc", HTTP_IF_NONE_MATCH="*"),
+        lambda s, h: captured.update(status=s),
+    ));
+    assert body == b"" and captured["status"].startswith("412");
+    try:
+        app.addRoute("GET", "/bad", lambda req, res: "Bad", etag="medium");
+        assert False;
+    except ValueError:
+        pass;
+
+def test_verbs ():
+    app = vilo.buildApp();
+    callCount = {"n": 0};
+    @app.route("GET", "/item")
+    def get_item (req, res):
+        callCount["n"] += 1;
+        return "Item!";
+    app.route(["POST", "DELETE"], "/item")(lambda req, res: "Changed!");
+    app.route("GET", "/cached", cache=60)(lambda req, res: "Cached!");
+    @app.route("GET", "/lazy")
+    def get_lazy (req, res):
+        if req.getVerb() == "HEAD":
+            res.setHeader("Content-Length", 1000);
+            return "";      # Skips generation.
+        return "x" * 1000;
+    captured = {};
+    def call (verb, path):
+        def start_response (statusLine, headerList):
+            captured.update(dict(headerList), status=statusLine);
+        captured.clear();
+        return b"".join(app.wsgi(mkEnviron(verb, path), start_response));
+    # HEAD, via GET handler, without body:
+    assert call("HEAD", "/item") == b"" and callCount["n"] == 1;
+    assert captured["status"].startswith("200") and captured["CONTENT-LENGTH"] == "5";
+    assert call("HEAD", "/lazy") == b"" and captured["CONTENT-LENGTH"] == "1000";
+    assert call("GET", "/cached") == b"Cached!";
+    assert call("HEAD", "/cached") == b"" and captured["CONTENT-LENGTH"] == "7";
+    # 405, with Allow:
+    assert b"Method not allowed." in call("PUT", "/item");
+    assert captured["status"].startswith("405");
+    assert captured["ALLOW"] == "DELETE, GET, HEAD, OPTIONS, POST";
+    call("PUT", "/nope");
+    assert captured["status"].startswith("404") and "ALLOW" not in captured;
+    # Automatic OPTIONS, unless routed explicitly:
+    assert call("OPTIONS", "/item") == b"";
+    assert captured["status"].startswith("204");
+    assert captured["ALLOW"] == "DELETE, GET, HEAD, OPTIONS, POST";
+    def plugin_cors (fn):
+        def wrapper (req, res, *a, **ka):
+            res.setHeader("Access-Control-Allow-Origin", "*");
+            return fn(req, res, *a, **ka);
+        return wrapper;
+    app.install(plugin_cors);   # After an auto-OPTIONS response.
+    call("OPTIONS", "/item");
+    assert captured["ACCESS-CONTROL-ALLOW-ORIGIN"] == "*";
+    app.route("OPTIONS", "/item")(lambda req, res: "Custom!");
+    assert call("OPTIONS", "/item") == b"Custom!";
+
+def test_benchmark ():
+    import tempfile, benchmark;
+    with tempfile.TemporaryDirectory() as staticDir:
+        scenarioMap = {s["name"]: s for s in benchmark.buildScenarioList(staticDir)};
+        for name in ["hello", "notFound", "jsonPost"]:
+            assert benchmark.runThroughput(scenarioMap[name], 20) > 0;
+            stageMap = benchmark.runStaged(scenarioMap[name], 20);
+            assert set(stageMap) == set(benchmark.STAGE_LIST);
+            assert stageMap["handler"] > 0 and stageMap["finish"] > 0;
+        assert scenarioMap["hello"]["app"].observerList == ();  # Removed.
+    try:
+        benchmark.main(["-n", "10", "hello", "json"]);
+        assert False;   # Unreachable, 'json' isn't a scenario.
+    except SystemExit as e:
+        assert e.code == 2;
+
 ############################################################
 # Run All Tests: ###########################################
 ############################################################
@@ -25,19 +25,34 @@ trademarks, service marks, brand names or logos of Polydojo, Inc.
 
 import os;
 import sys;
+import stat;
 import json;
 import re;
 import io;
+import tempfile;
 import functools;
+import collections;
+import threading;
+import queue;
+import time;
+import bisect;
+import math;
 import urllib.parse;
 import http.cookies;
 import mimetypes;
-import cgi;
+import email.utils;
 import traceback;
 import hashlib;
 import hmac;
 import base64;
+import zlib;
 import pprint;
+import asyncio;
+import inspect;
+import concurrent.futures;
+import socket;
+import signal;
+import wsgiref.simple_server;
 
 import dotsi;
 
@@ -49,6 +64,7 @@ __version__ = "0.0.6-preview";  # Req'd by flit.
 
 httpCodeLineMap = {
     200: "200 OK",
+    206: "206 Partial Content",
     301: "301 Moved Permanently",
     302: "302 Found",
     303: "303 See Other",
@@ -61,7 +77,9 @@ httpCodeLineMap = {
     405: "405 Method Not Allowed",
     408: "408 Request Timeout",
     410: "410 Gone",
+    412: "412 Precondition Failed",
     413: "413 Payload Too Large",
+    416: "416 Range Not Satisfiable",
     418: "418 I'm a teapot",
     429: "429 Too Many Requests",
     431: "431 Request Header Fields Too Large",
@@ -86,15 +104,31 @@ error = HttpError;  # Alias, short.
 
 KB = 1024;
 MB = KB**2;
-MAX_REQUEST_BODY_SIZE = 1 * MB; # TODO: Make configurable.
+MAX_REQUEST_BODY_SIZE = 1 * MB;     # Default, see app.setBodyLimits(.)
+BODY_SPOOL_SIZE = 1 * MB;           # Default, see app.setBodyLimits(.)
+BODY_CHUNK_SIZE = 64 * KB;
+MULTIPART_MAX_PARTS = 1000;
+MULTIPART_MAX_HEADER_SIZE = 16 * KB;
+FILE_BLOCK_SIZE = 64 * KB;
+FILE_META_CACHE_SIZE = 1024;
 
 mapli = lambda seq, fn: list(map(fn, seq));
 filterli = lambda seq, fn: list(filter(fn, seq));
 
-esc = lambda s: (str(s).replace("&", "&amp;")
-    .replace(">", "&gt;").replace("<", "&lt;")
-    .replace('"', "&quot;").replace("'", "&#039;")
-);
+def esc (s):
+    "Escapes HTML-special chars in `s` (or `str(s)`).";
+    # NB: Chained `.replace` beats `str.translate` here, as
+    #     it's a C-level scan that returns `s` itself when
+    #     there's nothing to replace, i.e. in the common case.
+    t = type(s);
+    if t is not str:
+        if t is int or t is float or t is bool or s is None:
+            return str(s);  # Nothing to escape.
+        s = str(s);
+    return (s.replace("&", "&amp;")
+        .replace(">", "&gt;").replace("<", "&lt;")
+        .replace('"', "&quot;").replace("'", "&#039;")
+    );
 
 def dictDefaults (dicty, defaults):
     "Adds `defaults` keys to `dicty`, WITHOUT overwriting.";
@@ -103,17 +137,73 @@ def dictDefaults (dicty, defaults):
             dicty[k] = defaults[k];
     return None;
 
+escfmtScalarTypes = (str, float, int, type(None), bool);  # Incl. subclasses.
+
 def escfmt (string, seq):
     "Like built-in %s formatting, but with HTML-escaping.";
-    if isinstance(seq, (str, float, int, type(None), bool)):
-        seq = [seq];
+    # Direct, for one-off calls. For reused templates (eg. per
+    # row), see compileEscfmt(.) below.
+    if isinstance(seq, escfmtScalarTypes):
+        return string % (esc(seq),);
     if isinstance(seq, (list, tuple)):
-        return string % tuple(mapli(seq, esc));
+        return string % tuple(map(esc, seq));
     if isinstance(seq, dict):
-        dct = {};
-        for (k, v) in seq.items():
-            dct[str(k)] = esc(str(v));
-        return string % dct;
+        return string % {str(k): esc(v) for (k, v) in seq.items()};
+    return None;
+
+ESCFMT_CACHE_SIZE = 256;    # Compiled templates.
+ESCFMT_BATCH_ROWS = 100;    # Rows per chunk, see iterRows(.) below.
+escfmtNamePattern = re.compile(r"%\(([^)]*)\)");
+
+@functools.lru_cache(maxsize=ESCFMT_CACHE_SIZE)
+def compileEscfmt (string):
+    "Compiles `string` into a reusable, escfmt(.)-like template.";
+    tpl = dotsi.fy({"string": string});
+    # Only keys referenced by `%(key)s` specs need escaping:
+    nameSet = frozenset(escfmtNamePattern.findall(string.replace("%%", "")));
+    
+    def render (seq):
+        "Like escfmt(string, seq).";
+        if isinstance(seq, escfmtScalarTypes):
+            return string % (esc(seq),);
+        if isinstance(seq, (list, tuple)):
+            return string % tuple(map(esc, seq));
+        if isinstance(seq, dict):
+            # No `nameSet` => positional, eg "%s" % {..}; keep all, like escfmt(.)
+            return string % {
+                str(k): esc(v) for (k, v) in seq.items()
+                if not nameSet or str(k) in nameSet
+            };
+        return None;    # Like escfmt(.), for other types.
+    tpl.render = render;
+    
+    def renderChunks (rows):
+        "Renders each of `rows`, returning a list of str chunks.";
+        return [
+            string % tuple(map(esc, row)) if type(row) is tuple else render(row)
+            for row in rows     # ^ Fast path, for the common case.
+        ];
+    tpl.renderChunks = renderChunks;
+    
+    def renderRows (rows):
+        "Renders each of `rows`, returning a single str.";
+        return "".join(renderChunks(rows));
+    tpl.renderRows = renderRows;
+    
+    def iterRows (rows, batchSize=ESCFMT_BATCH_ROWS):
+        "Lazily renders `rows`, yielding a str chunk per `batchSize` rows.";
+        # Batched, as a chunk per row would make for tiny writes.
+        batch = [];
+        for row in rows:
+            batch.append(render(row));
+            if len(batch) >= batchSize:
+                yield "".join(batch);
+                batch = [];
+        if batch:
+            yield "".join(batch);
+    tpl.iterRows = iterRows;
+    
+    return tpl;
 
 # String encoding and cookie-signing related: ::::::::::::::
 
@@ -139,39 +229,144 @@ def utf8_to_latin1 (s):
     assert type(s) is str;  # str i/p, str o/p.
     return s.encode("utf8").decode("latin1");
 
+# JSON codec: ::::::::::::::::::::::::::::::::::::::::::::::
+
+def buildJsonCodec (dumps=None, loads=None, default=None):
+    "Builds a JSON codec. Without `dumps` & `loads`, uses stdlib `json`.";
+    # encode(.) always returns `bytes`; decode(.) accepts `bytes`.
+    # `default` serializes custom types, like `json.dumps`' default.
+    if dumps is None:
+        encoder = json.JSONEncoder(default=default);
+        dumps = lambda x: encoder.encode(x);
+    elif default is not None:
+        customDumps = dumps;
+        dumps = lambda x: customDumps(x, default=default);
+    loads = loads or json.loads;
+    def encode (x):
+        out = dumps(x);
+        return out if type(out) is bytes else out.encode("utf8");
+    return dotsi.fy({"encode": encode, "decode": loads});
+
+def detectJsonCodec (default=None):
+    "Returns an `orjson`-based codec if installed, else stdlib `json`'s.";
+    try:
+        import orjson;
+    except ImportError:
+        return buildJsonCodec(default=default);
+    return buildJsonCodec(orjson.dumps, orjson.loads, default);
+
+stdJsonCodec = buildJsonCodec();
+
 def hmacy (b_msg, b_secret, digestmod=hashlib.sha512):
     "HMAC helper.";
     assert type(b_msg) is bytes and type(b_secret) is bytes;
     return hmac.HMAC(b_secret, b_msg, digestmod).digest();    
 
 B_SIGN_SEP = b"@|";  # SIGNing SEParator, of type `bytes`.
+SIGN_DIGEST = "sha512";         # Default, for compatibility.
+SIGN_VERIFY_CACHE_SIZE = 256;   # Recently verified cookie strings.
+
+def buildSigner (secrets, digest=SIGN_DIGEST, verifyCacheSize=SIGN_VERIFY_CACHE_SIZE, codec=stdJsonCodec):
+    "Builds a reusable signer. Signs with `secrets[0]`, verifies with any.";
+    # `secrets` may be a single str/bytes secret, or a list thereof,
+    # newest first, for key rotation. `digest` is a hashlib name,
+    # eg. "sha512" (default), "sha256" or "blake2b". `codec` is
+    # a JSON codec, see buildJsonCodec(.)
+    if type(secrets) in [str, bytes]:
+        secrets = [secrets];
+    if not secrets:
+        raise ValueError("Expected at least one secret.");
+    # HMACs are pre-keyed once, and `.copy()`-ed per message:
+    keyedList = [hmac.new(toBytes(s), digestmod=digest) for s in secrets];
+    signer = dotsi.fy({"digest": digest});
+    # NB: Method names mustn't shadow `dict` methods (eg. get, copy).
+    verifiedMap = collections.OrderedDict();    # signed => b_jval
+    lock = threading.Lock();
+    counts = {"hits": 0, "misses": 0};
+    
+    def computeSig (keyed, b_msg):
+        h = keyed.copy();
+        h.update(b_msg);
+        return h.digest();
+    
+    def wrap (value):
+        "Signs `value`.";
+        b_jval = codec.encode(value);
+        b64_sig = base64.b64encode(computeSig(keyedList[0], b_jval));
+        assert B_SIGN_SEP not in b64_sig;
+        return toStr(b64_sig + B_SIGN_SEP + base64.b64encode(b_jval));
+    signer.wrap = wrap;
+    
+    def verify (signed):
+        "Returns JSON bytes if `signed` is validly signed, else None.";
+        b_signed = toBytes(signed);
+        b64_sig, b64_jval = b_signed.split(B_SIGN_SEP, 1);
+        try:
+            b_sig = base64.b64decode(b64_sig, validate=True);
+            b_jval = base64.b64decode(b64_jval, validate=True);
+        except ValueError:
+            return None;
+        for keyed in keyedList:
+            if hmac.compare_digest(b_sig, computeSig(keyed, b_jval)):
+                return b_jval;
+        return None;
+    
+    def unwrap (signed):
+        "If validly `signed`, returns original value, else None.";
+        if not (type(signed) is str and toStr(B_SIGN_SEP) in signed):
+            return None;
+        # otherwise ...
+        with lock:
+            jval = verifiedMap.get(signed);
+            if jval is not None:
+                verifiedMap.move_to_end(signed);
+                counts["hits"] += 1;
+        if jval is None:
+            jval = verify(signed);
+            if jval is None:
+                return None;    # Invalid ones aren't cached.
+            with lock:
+                counts["misses"] += 1;
+                verifiedMap[signed] = jval;
+                while len(verifiedMap) > verifyCacheSize:
+                    verifiedMap.popitem(last=False);
+        try:
+            return codec.decode(jval);  # Fresh object per call.
+        except ValueError:
+            return None;
+    signer.unwrap = unwrap;
+    
+    def getStats ():
+        "Returns verify-cache stats.";
+        with lock:
+            return dict(counts, entries=len(verifiedMap));
+    signer.getStats = getStats;
+    
+    return signer;
+
+@functools.lru_cache(maxsize=64)
+def getCachedSigner (secretTuple):
+    return buildSigner(list(secretTuple));
+
+def toSigner (secret):
+    "Returns signer for `secret`: a str/bytes, list thereof, or signer.";
+    if isinstance(secret, dict):
+        return secret;  # Already a signer.
+    if isinstance(secret, (list, tuple)):
+        return getCachedSigner(tuple(secret));
+    return getCachedSigner((secret,));
 
 def signWrap (value, secret):
     "Signs `value` using `secret`.";
-    b_jval = toBytes(json.dumps(value));
-    b_secret = toBytes(secret);
-    b_sig = hmacy(b_jval, b_secret);
-    b64_jval = base64.b64encode(b_jval);
-    b64_sig = base64.b64encode(b_sig);
-    assert type(b64_sig) is bytes and B_SIGN_SEP not in b64_sig;
-    b_signed = b64_sig + B_SIGN_SEP + b64_jval;
-    return toStr(b_signed);
+    return toSigner(secret).wrap(value);
 
 def signUnwrap (signed, secret):
     "If `signed` with `secret`, returns original value.";
-    if not (type(signed) is str and toStr(B_SIGN_SEP) in signed):
-        return None;
-    # otherwise ...
-    b_secret = toBytes(secret);
-    b_signed = toBytes(signed);
-    b64_sig, b64_jval = b_signed.split(B_SIGN_SEP, 1);
-    b_jval = base64.b64decode(b64_jval);
-    b_sig = base64.b64decode(b64_sig);
-    b_sigComputed = hmacy(b_jval, b_secret);
-    if b_sig != b_sigComputed:
-        return None;
-    # otherwise ...
-    return json.loads(toStr(b_jval));
+    return toSigner(secret).unwrap(signed);
+
+def formatTraceback (err):
+    "Formats `err`'s traceback, even outside of the `except` block.";
+    return "".join(traceback.format_exception(type(err), err, err.__traceback__));
 
 def test_signWrap (value, secret):
     "Testing helper.";
@@ -181,46 +376,298 @@ def test_signWrap (value, secret):
 # Request: #################################################
 ############################################################
 
-def buildRequest (environ):
-    req = dotsi.fy({});
+_UNSET = object();   # Sentinel for not-yet-computed values.
+
+def mkLazyProperty (slot, compute):
+    "Makes a property that computes (& memoizes) into `slot`.";
+    def getter (self):
+        value = getattr(self, slot);
+        if value is _UNSET:
+            value = compute(self);
+            setattr(self, slot, value);
+        return value;
+    def setter (self, value):
+        setattr(self, slot, value);
+    return property(getter, setter, doc=compute.__doc__);
+
+def parseQs (qs):
+    "Parses query string into dict.";
+    return dict(urllib.parse.parse_qsl(qs, keep_blank_values=True));    # parse_qsl(.) returns list of 2-tuples, then dict-ify
+
+# Multipart parsing: . . . . . . . . . . . . . . . . . . . .
+
+def getMultipartBoundary (contentType):
+    "Extracts boundary (as `bytes`) from `contentType`, else None.";
+    m = re.search(r'boundary=(?:"([^"]+)"|([^;\s]+))', contentType);
+    if not m:
+        return None;
+    return (m.group(1) or m.group(2)).encode("latin1");
+
+def parseHeaderParams (value):
+    "Parses 'form-data; name=\"a\"; filename=\"b\"' to dict.";
+    paramMap = {};
+    for m in re.finditer(r';\s*([\w*-]+)=("(?:[^"\\]|\\.)*"|[^;]*)', value):
+        key, val = m.group(1).lower(), m.group(2).strip();
+        if val.startswith('"'):
+            val = re.sub(r'\\(.)', r'\1', val[1 : -1]);
+        if key.endswith("*"):   # RFC 5987, eg: utf-8''na%C3%AFve.txt
+            key = key[ : -1];
+            val = urllib.parse.unquote(val.split("'", 2)[-1]);
+        paramMap[key] = val;
+    return paramMap;
+
+def parseMultipartHeaders (bHeaders):
+    "Parses a part's header block into a dict of lowercase keys.";
+    headerMap = {};
+    for line in bHeaders.decode("utf8", "replace").split("\r\n"):
+        if ":" in line:
+            name, value = line.split(":", 1);
+            headerMap[name.strip().lower()] = value.strip();
+    return headerMap;
+
+def parseMultipart (chunks, boundary, spoolSize, maxPartSize=None, maxParts=MULTIPART_MAX_PARTS):
+    "Incrementally parses multipart/form-data from `chunks`.";
+    # Fields are kept in memory, as `str`. File parts are kept in
+    # memory up to `spoolSize`, beyond which they go to a temp file.
+    # File parts look like: {"filename", "mimeType", "file", "bytes"},
+    # with "bytes" being None if the part was spilled to disk.
+    chunkIter = iter(chunks);
+    delim = b"\r\n--" + boundary;
+    keep = len(delim) + 4;      # Tail, held back between chunks.
+    state = {"buf": b"\r\n"};   # Leading CRLF, so 1st delim matches.
+    badRequest = lambda: HttpError("<h2>Bad Multipart Body</h2>", 400);
+    tooLarge = lambda: HttpError(
+        "<h2>Request Too Large</h2>", 413, "request_too_large",
+    );
+    def fill ():
+        chunk = next(chunkIter, None);
+        if not chunk:
+            raise badRequest();     # Unexpected end of body.
+        state["buf"] += chunk;
+    # Skip preamble, upto the first delimiter:
+    while delim not in state["buf"]:
+        state["buf"] = state["buf"][-keep : ];
+        fill();
+    state["buf"] = state["buf"][state["buf"].index(delim) + len(delim) : ];
+    parsedData = {};
+    partCount = 0;
+    while True:
+        ## Step 1. After a delimiter, either '--' (end) or CRLF:
+        while len(state["buf"]) < 2:
+            fill();
+        if state["buf"].startswith(b"--"):
+            return parsedData;
+        if not state["buf"].startswith(b"\r\n"):
+            raise badRequest();
+        partCount += 1;
+        if partCount > maxParts:
+            raise tooLarge();
+        ## Step 2. Part headers:
+        while b"\r\n\r\n" not in state["buf"]:
+            if len(state["buf"]) > MULTIPART_MAX_HEADER_SIZE:
+                raise badRequest();
+            fill();
+        bHeaders, state["buf"] = state["buf"][2 : ].split(b"\r\n\r\n", 1);
+        headerMap = parseMultipartHeaders(bHeaders);
+        paramMap = parseHeaderParams(headerMap.get("content-disposition", ""));
+        name = paramMap.get("name");
+        filename = paramMap.get("filename");
+        ## Step 3. Part body, streamed into memory or temp file:
+        memChunks, memSize, fileObj, size = [], 0, None, 0;
+        while True:
+            buf = state["buf"];
+            index = buf.find(delim);
+            if index != -1:
+                data, state["buf"] = buf[ : index], buf[index + len(delim) : ];
+            else:
+                cut = max(0, len(buf) - keep);
+                data, state["buf"] = buf[ : cut], buf[cut : ];
+            size += len(data);
+            if maxPartSize is not None and size > maxPartSize:
+                if fileObj: fileObj.close();
+                raise tooLarge();
+            if data and fileObj:
+                fileObj.write(data);
+            elif data:
+                memChunks.append(data);
+                memSize += len(data);
+                if filename and memSize > spoolSize:
+                    fileObj = tempfile.TemporaryFile();
+                    fileObj.write(b"".join(memChunks));
+                    memChunks = [];
+            if index != -1:
+                break;
+            fill();
+        ## Step 4. Collect:
+        if name is None:
+            if fileObj: fileObj.close();
+            continue;   # Nameless part, ignore.
+        if not filename:
+            parsedData[name] = b"".join(memChunks).decode("utf8", "replace");
+            continue;
+        # otherwise ...
+        bData = None;
+        if fileObj:
+            fileObj.seek(0);
+        else:
+            bData = b"".join(memChunks);
+            fileObj = io.BytesIO(bData);
+        parsedData[name] = {
+            "filename": filename,
+            "bytes": bData,     # None, if spilled to disk.
+            "file": fileObj,
+            "mimeType": headerMap.get("content-type", "text/plain").split(";")[0].strip().lower(),
+        };
+
+class Request (object):
+    "Slotted request object, with lazily computed attributes.";
+    # Costlier attributes (cookieJar, bodyBytes, url, splitUrl,
+    # qdata, fdata, contentType) are computed on first access
+    # and then memoized. So a handler that only reads
+    # `req.wildcards` doesn't pay for body/cookie/form parsing.
+    __slots__ = (
+        "_environ", "wildcards", "matched", "app", "response",
+        "_cookieJar", "_bodyBytes", "_splitUrl", "_url",
+        "_qdata", "_fdata", "_contentType", "_jsonCodec",
+        "_bodyFile", "_bodyStreamed", "_maxBodySize", "_spoolSize",
+        "_maxPartSize", "_session",
+        "__dict__",     # Allocated only if a plugin adds attrs.
+    );
     
-    req.getEnviron = lambda: environ;
+    def __init__ (self, environ):
+        self._environ = environ;
+        self.wildcards = [];
+        self.matched = None;
+        self.app = None;
+        self.response = None;
+        self._cookieJar = _UNSET;
+        self._bodyBytes = _UNSET;
+        self._splitUrl = _UNSET;
+        self._url = _UNSET;
+        self._qdata = _UNSET;
+        self._fdata = _UNSET;
+        self._jsonCodec = stdJsonCodec;   # Set by app.
+        self._contentType = _UNSET;
+        self._bodyFile = _UNSET;
+        self._bodyStreamed = False;
+        self._maxBodySize = MAX_REQUEST_BODY_SIZE;    # Set by app.
+        self._spoolSize = BODY_SPOOL_SIZE;            # Set by app.
+        self._maxPartSize = None;                     # Set by app.
+        self._session = _UNSET;
     
-    def ekey (key, default=None):
+    def getEnviron (self):
+        return self._environ;
+    
+    def _ekey (self, key, default=None):
         # Utf8-friendly wrapper around environ.
-        if key not in environ: return default;
-        return latin1_to_utf8(environ[key]);
+        if key not in self._environ: return default;
+        return latin1_to_utf8(self._environ[key]);
         ##Consider::
         #value = environ[key];
         #if value is str: return latin1_to_utf8(value);
         #return value;
-    req._ekey = ekey;
-    
-    req.getPathInfo = lambda: ekey("PATH_INFO", "/");
-    req.getVerb = lambda: ekey("REQUEST_METHOD", "GET").upper();
-    req.wildcards = [];
-    req.matched = None;
-    req.cookieJar = http.cookies.SimpleCookie(ekey("HTTP_COOKIE", ""));
-    
-    req.app = None;
-    req.response = None;
-    def bindApp (app, response):
-        req.app = app;
-        req.response = response;
-    req.bindApp = bindApp;
-    
-    req.bodyBytes = b"";
-    def fillBody ():
-        fileLike = environ["wsgi.input"]; # Not ekey(.)
-        req.bodyBytes = fileLike.read(MAX_REQUEST_BODY_SIZE);
-        assert type(req.bodyBytes) is bytes;
-        if fileLike.read(1) != b"":
-            raise HttpError("<h2>Request Too Large</h2>", 413, "request_too_large");
-    fillBody(); # Immediately called.
     
-    req.url = "";
-    req.splitUrl = urllib.parse.urlsplit("");
-    def reconstructUrl ():
+    def getPathInfo (self):
+        return self._ekey("PATH_INFO", "/");
+    
+    def getVerb (self):
+        return self._ekey("REQUEST_METHOD", "GET").upper();
+    
+    def bindApp (self, app, response):
+        self.app = app;
+        self.response = response;
+    
+    def getHeader (self, name):
+        cgikey = name.upper().replace("-", "_");
+        if cgikey not in ["CONTENT_TYPE", "CONTENT_LENGTH"]:
+            cgikey = "HTTP_" + cgikey;
+        return self._ekey(cgikey);
+    
+    def _computeCookieJar (self):
+        "Parsed request cookies, a `SimpleCookie`.";
+        return http.cookies.SimpleCookie(self._ekey("HTTP_COOKIE", ""));
+    cookieJar = mkLazyProperty("_cookieJar", _computeCookieJar);
+    
+    # Request body: . . . . . . . . . . . . . . . . . . . .
+    #   req.stream():  Yields body chunks; for incremental use.
+    #   req.bodyFile:  Seekable, spooled to disk if large.
+    #   req.bodyBytes: Entire body, as `bytes`.
+    # Each enforces the body size limit (per-route or per-app).
+    
+    def getContentLength (self):
+        "Returns Content-Length as `int`, else None.";
+        cl = self._environ.get("CONTENT_LENGTH");  # Not ekey(.)
+        if not cl:
+            return None;
+        try:
+            return int(cl);
+        except ValueError:
+            raise HttpError("<h2>Bad Content-Length</h2>", 400);
+    
+    def _raiseTooLarge (self):
+        raise HttpError("<h2>Request Too Large</h2>", 413, "request_too_large");
+    
+    def _checkContentLength (self):
+        "Rejects too-large requests early, before reading.";
+        cl = self.getContentLength();
+        if cl is not None and cl > self._maxBodySize:
+            self._raiseTooLarge();
+    
+    def stream (self, chunkSize=BODY_CHUNK_SIZE):
+        "Yields request body in chunks of up to `chunkSize` bytes.";
+        if self._bodyBytes is not _UNSET:
+            for i in range(0, len(self._bodyBytes), chunkSize):
+                yield self._bodyBytes[i : i + chunkSize];
+            return None;
+        if self._bodyFile is not _UNSET:
+            self._bodyFile.seek(0);
+            yield from iter(lambda: self._bodyFile.read(chunkSize), b"");
+            self._bodyFile.seek(0);
+            return None;
+        if self._bodyStreamed:
+            raise RuntimeError("Request body has already been streamed.");
+        # otherwise ...
+        self._bodyStreamed = True;
+        self._checkContentLength();
+        fileLike = self._environ["wsgi.input"]; # Not ekey(.)
+        cl = self.getContentLength();
+        remaining = cl if cl is not None else self._maxBodySize + 1;
+        # ^ Without Content-Length, read 1 extra byte to detect overflow.
+        while remaining > 0:
+            chunk = fileLike.read(min(chunkSize, remaining));
+            assert type(chunk) is bytes;
+            if not chunk:
+                break;
+            remaining -= len(chunk);
+            if cl is None and remaining <= 0:
+                self._raiseTooLarge();
+            yield chunk;
+        return None;
+    
+    def _computeBodyFile (self):
+        "Request body, as a seekable (spooled) temporary file.";
+        if self._bodyBytes is not _UNSET:
+            return io.BytesIO(self._bodyBytes);
+        # otherwise ...
+        f = tempfile.SpooledTemporaryFile(max_size=self._spoolSize);
+        try:
+            for chunk in self.stream():
+                f.write(chunk);
+        except BaseException:
+            f.close();
+            raise;
+        f.seek(0);
+        return f;
+    bodyFile = mkLazyProperty("_bodyFile", _computeBodyFile);
+    
+    def _computeBodyBytes (self):
+        "Request body, as `bytes`.";
+        return b"".join(self.stream());
+    bodyBytes = mkLazyProperty("_bodyBytes", _computeBodyBytes);
+    
+    def _computeSplitUrl (self):
+        "Reconstructed request URL, a `SplitResult`.";
+        ekey = self._ekey;
         # Scheme:
         scheme = (ekey("HTTP_X_FORWARDED_PROTO") or
             ekey("wsgi.url_scheme") or "http"   #or
@@ -241,132 +688,583 @@ def buildRequest (environ):
         # Fragment:
         fragment = "";
         # Full URL:
-        req.splitUrl = urllib.parse.SplitResult(
+        return urllib.parse.SplitResult(
             scheme, netloc, path, query, fragment,
         );
-        #print("type(req.splitUrl) = ", type(req.splitUrl));
-        #print("(req.splitUrl) = ", (req.splitUrl));
-        req.url = req.splitUrl.geturl();
-    reconstructUrl();   # Immediately called.
+    splitUrl = mkLazyProperty("_splitUrl", _computeSplitUrl);
     
     # TODO: Handle HTTP_X_FORWARDED_FOR, HTTP_X_FORWARDED_PORT,
     #               HTTP_X_FORWARDED_PREFIX, etc.
     
-    def getHeader (name):
-        cgikey = name.upper().replace("-", "_");
-        if cgikey not in ["CONTENT_TYPE", "CONTENT_LENGTH"]:
-            cgikey = "HTTP_" + cgikey;
-        return ekey(cgikey);
-    req.getHeader = getHeader;
-    req.contentType = getHeader("CONTENT_TYPE");
-    
-    def parseQs (qs):
-        "Parses query string into dict.";
-        return dict(urllib.parse.parse_qsl(qs, keep_blank_values=True));    # parse_qsl(.) returns list of 2-tuples, then dict-ify
-    req.qdata = parseQs(req.splitUrl.query);    # IMMEDIATE.
-    
-    
-    def helper_parseMultipartFormData ():
-        assert req.contentType.startswith("multipart/form-data");
-        parsedData = {};
-        miniEnviron = {
-            # Not ekey(.), use environ.get(.) directly:
-            "QUERY_STRING": environ.get("QUERY_STRING"),
-            "REQUEST_METHOD": environ.get("REQUEST_METHOD"),
-            "CONTENT_TYPE": environ.get("CONTENT_TYPE"),
-            "CONTENT_LENGTH": len(req.bodyBytes),
-        };
-        fieldData = cgi.FieldStorage(
-            fp = io.BytesIO(req.bodyBytes),
-            environ = miniEnviron, encoding = "utf8",
-            keep_blank_values = True,
+    def _computeUrl (self):
+        "Reconstructed request URL, a `str`.";
+        return self.splitUrl.geturl();
+    url = mkLazyProperty("_url", _computeUrl);
+    
+    def _computeContentType (self):
+        "Request Content-Type header, else None.";
+        return self.getHeader("CONTENT_TYPE");
+    contentType = mkLazyProperty("_contentType", _computeContentType);
+    
+    def _computeQdata (self):
+        "Query string data, a `dotsi.Dict`.";
+        return dotsi.fy(parseQs(self._ekey("QUERY_STRING", "")));
+    qdata = mkLazyProperty("_qdata", _computeQdata);
+    
+    def _helper_parseMultipartFormData (self):
+        assert self.contentType.startswith("multipart/form-data");
+        boundary = getMultipartBoundary(self.contentType);
+        if not boundary:
+            raise HttpError("<h2>Bad Multipart Boundary</h2>", 400);
+        return parseMultipart(
+            self.stream(), boundary, self._spoolSize, self._maxPartSize,
         );
-        fieldList = fieldData.list or [];
-        for field in fieldList:
-            if field.filename:
-                parsedData[field.name] = {
-                    "filename": field.filename,
-                    "bytes": field.file.read(),
-                    "mimeType": field.headers.get_content_type(),       # TODO: Investigate if this includes charset.
-                    #?"charset": field.headers.get_charset(),
-                    #?"headers": field.headers,
-                };
-            else:
-                parsedData[field.name] = field.value;
-        return parsedData;
-    
-    req.fdata = {};
-    def fill_fdata ():
-        if not req.contentType:
-            pass;   # Falsy contentType, ignore.
-        elif req.contentType == "application/json":
-            req.fdata = json.loads(req.bodyBytes);
-        elif req.contentType.startswith("multipart/form-data"):
-            req.fdata = helper_parseMultipartFormData();
-        elif req.contentType.startswith("application/x-www-form-urlencoded"):
-            req.fdata = parseQs(req.bodyBytes.decode("latin1"));
+    
+    def _computeFdata (self):
+        "Posted form (or JSON) data, usually a `dotsi.Dict`.";
+        contentType = self.contentType;
+        if not contentType:
+            return dotsi.fy({});   # Falsy contentType, ignore.
+        elif contentType == "application/json":
+            try:
+                return dotsi.fy(self._jsonCodec.decode(self.bodyBytes));
+            except ValueError:
+                raise HttpError("<h2>Bad JSON Body</h2>", 400);
+        elif contentType.startswith("multipart/form-data"):
+            return dotsi.fy(self._helper_parseMultipartFormData());
+        elif contentType.startswith("application/x-www-form-urlencoded"):
+            return dotsi.fy(parseQs(self.bodyBytes.decode("latin1")));
             # "utf8" wont't to work, WSGI uses "latin1" ^^
         else:
-            pass;   # Other contentType, ignore.
-    fill_fdata();       # Immediately called.
-
-    def getUnsignedCookie (name):
-        morsel = req.cookieJar.get(name);
+            return dotsi.fy({});   # Other contentType, ignore.
+    fdata = mkLazyProperty("_fdata", _computeFdata);
+    
+    def getUnsignedCookie (self, name):
+        morsel = self.cookieJar.get(name);
         return morsel.value if morsel else None;
-    req.getUnsignedCookie = getUnsignedCookie;
     
-    def getCookie (name, secret=None):
-        uVal = getUnsignedCookie(name); # Unsigned-ready val.
+    def getCookie (self, name, secret=None):
+        uVal = self.getUnsignedCookie(name); # Unsigned-ready val.
         if not uVal: return None;
         if not secret: return uVal;
         return signUnwrap(uVal, secret);
-    req.getCookie = getCookie;
+    
+    def _computeSession (self):
+        "Server-side session, a `Session` dict. See `app.setSessions(.)`";
+        config = self.app.sessionConfig if self.app else None;
+        if config is None:
+            raise ValueError("Sessions aren't enabled, see app.setSessions(.)");
+        sid = self.getCookie(config.cookieName, config.signer);
+        data = config.store.load(sid) if type(sid) is str else None;
+        return Session() if data is None else Session(sid, data);
+    session = mkLazyProperty("_session", _computeSession);
 
-    # Return built `req`:
-    return req;
+def buildRequest (environ):
+    "Builds a (lazy) `Request` object around `environ`.";
+    return Request(environ);
 
 ############################################################
 # Response: ################################################
 ############################################################
 
-def buildResponse (start_response):
-    res = dotsi.fy({});
-    res.statusLine = "200 OK";
-    res.contentType = "text/html; charset=UTF-8";
-    res._headerMap = {};
-    res.cookieJar = http.cookies.SimpleCookie();
-    #res._bOutput = b"";
-   
-    res.update({"app": None, "request": None});
-    def bindApp (appObject, reqObject):
-        res.update({"app": appObject, "request": reqObject});
-    res.bindApp = bindApp;
-    
-    def setHeader (name, value):
+def headerToLatin1 (value):
+    "Like utf8_to_latin1(.), but skips pure-ASCII values.";
+    if value.isascii():
+        return value;   # ASCII is identical in latin1.
+    return utf8_to_latin1(value);
+
+latin1StatusLineMap = {     # Memoized, see statusLineToLatin1(.)
+    line: utf8_to_latin1(line) for line in httpCodeLineMap.values()
+};
+
+def statusLineToLatin1 (statusLine):
+    "Encodes `statusLine`, memoized for `httpCodeLineMap` lines.";
+    latin1Line = latin1StatusLineMap.get(statusLine);
+    if latin1Line is None:
+        return headerToLatin1(statusLine);
+    return latin1Line;
+
+def encodeHeaders (headers):
+    "Encodes `headers` (dict or list of pairs) for reuse.";
+    if type(headers) is dict:
+        headers = list(headers.items());
+    return tuple(   # Tuple, so that dotsi doesn't dotsi-fy it.
+        (name.strip().upper(), headerToLatin1(value))
+        for (name, value) in headers #,
+    );
+
+def isStreamBody (x):
+    "True if handler output `x` should be streamed (i.e. is an iterator).";
+    if isinstance(x, (str, bytes)):
+        return False;
+    return hasattr(x, "__next__") or hasattr(x, "__anext__");
+
+def toChunkBytes (chunk):
+    "Converts a streamed chunk to `bytes`.";
+    if type(chunk) is bytes:
+        return chunk;
+    if isinstance(chunk, str):
+        return chunk.encode("utf8");
+    if isinstance(chunk, (bytes, bytearray, memoryview)):
+        return bytes(chunk);
+    # otherwise, eg. `bytes(3)` would silently be b"\x00\x00\x00" ...
+    raise TypeError("Streamed chunks must be str or bytes-like, not %r." % type(chunk).__name__);
+
+class ResponseStream (object):
+    "WSGI response iterable, wrapping an iterator of str/bytes chunks.";
+    # WSGI servers call `.close()` on the returned iterable, which
+    # is forwarded to the wrapped iterator (eg. generator or file),
+    # followed by any hooks added via `.addCloseHook(.)`.
+    # Async iterators (eg. from async handlers, via `app.asgi`)
+    # are consumed via `.aiterBytes()` and `.aclose()` instead.
+    __slots__ = ("_iterable", "_closeHooks", "_filterList");
+    
+    def __init__ (self, iterable):
+        self._iterable = iterable;
+        self._closeHooks = [];
+        self._filterList = [];
+    
+    def isAsync (self):
+        return hasattr(self._iterable, "__anext__");
+    
+    def addFilter (self, feed, flush):
+        "Adds a chunk filter, eg. (compressor.compress, compressor.flush).";
+        self._filterList.append((feed, flush));
+    
+    def _applyFilters (self, chunk):
+        for (feed, flush) in self._filterList:
+            if not chunk:
+                break;
+            chunk = feed(chunk);
+        return chunk;
+    
+    def _flushFilters (self):
+        tail = b"";
+        for (feed, flush) in self._filterList:
+            tail = (feed(tail) if tail else b"") + flush();
+        return tail;
+    
+    def __iter__ (self):
+        for chunk in self._iterable:
+            chunk = self._applyFilters(toChunkBytes(chunk));
+            if chunk:
+                yield chunk;
+        if self._filterList:
+            tail = self._flushFilters();
+            if tail:
+                yield tail;
+    
+    async def aiterBytes (self):
+        "Like `__iter__`, but for async iterators.";
+        async for chunk in self._iterable:
+            chunk = self._applyFilters(toChunkBytes(chunk));
+            if chunk:
+                yield chunk;
+        if self._filterList:
+            tail = self._flushFilters();
+            if tail:
+                yield tail;
+    
+    def addCloseHook (self, fn):
+        "Adds `fn`, to be called (without args) upon `.close()`.";
+        self._closeHooks.append(fn);
+    
+    def _runCloseHooks (self):
+        hooks, self._closeHooks = self._closeHooks, [];
+        for fn in hooks:
+            fn();
+    
+    def close (self):
+        try:
+            if hasattr(self._iterable, "close"):
+                self._iterable.close();
+        finally:
+            self._runCloseHooks();
+    
+    async def aclose (self):
+        try:
+            if hasattr(self._iterable, "aclose"):
+                await self._iterable.aclose();
+            elif hasattr(self._iterable, "close"):
+                self._iterable.close();
+        finally:
+            self._runCloseHooks();
+
+# Deferred tasks: . . . . . . . . . . . . . . . . . . . . . .
+
+DEFER_THREADS = 4;
+DEFER_MAX_QUEUE = 1000;
+deferOverflowPolicySet = {"drop", "inline", "block"};
+
+def reportTaskError (err, fn):
+    "Default error hook for deferred tasks.";
+    print("\nDeferred task %r failed:\n%s\n" % (fn, formatTraceback(err)));
+
+def runTask (fn, args, kwargs, onError):
+    "Runs `fn`, reporting (not raising) errors. Returns True if ok.";
+    try:
+        fn(*args, **kwargs);
+        return True;
+    except Exception as e:
+        (onError or reportTaskError)(e, fn);
+        return False;
+
+def buildTaskPool (threads=DEFER_THREADS, maxQueue=DEFER_MAX_QUEUE, overflow="drop", onError=None):
+    "Builds a bounded pool of (lazily started) threads, for deferred tasks.";
+    # When the queue is full, `overflow` decides: "drop" the task
+    # (reported to `onError` as an OverflowError), run it "inline"
+    # (in the submitting thread), or "block" until there's room.
+    if overflow not in deferOverflowPolicySet:
+        raise ValueError("Unexpected overflow policy %r." % (overflow,));
+    pool = dotsi.fy({"threads": threads, "maxQueue": maxQueue, "overflow": overflow});
+    state = {"pid": None, "queue": None};   # Per process, see ensureStarted()
+    lock = threading.Lock();
+    idle = threading.Condition(lock);
+    counts = {"pending": 0, "completed": 0, "failed": 0, "dropped": 0, "inlined": 0};
+    
+    def runAndCount (fn, args, kwargs):
+        ok = runTask(fn, args, kwargs, onError);
+        with lock:
+            counts["pending"] -= 1;
+            counts["completed" if ok else "failed"] += 1;
+            if not counts["pending"]:
+                idle.notify_all();
+    
+    def workerLoop (taskQueue):
+        while True:
+            runAndCount(*taskQueue.get());
+    
+    def ensureStarted ():
+        # Threads don't survive fork(.), so (re)start them per process.
+        pid = os.getpid();
+        if state["pid"] == pid:
+            return state["queue"];
+        with lock:
+            if state["pid"] != pid:
+                taskQueue = queue.Queue(maxQueue);
+                for i in range(threads):
+                    threading.Thread(
+                        target=workerLoop, args=(taskQueue,), daemon=True,
+                        name="vilo-defer-%d" % i,
+                    ).start();
+                state["queue"], state["pid"] = taskQueue, pid;
+                counts["pending"] = 0;
+        return state["queue"];
+    
+    def submit (fn, args=(), kwargs=None):
+        "Queues `fn(*args, **kwargs)`. Returns False if dropped.";
+        task = (fn, args, kwargs or {});
+        taskQueue = ensureStarted();
+        with lock:
+            counts["pending"] += 1;
+        try:
+            taskQueue.put(task, block=(overflow == "block"));
+            return True;
+        except queue.Full:
+            pass;
+        # otherwise ...
+        if overflow == "inline":
+            with lock:
+                counts["inlined"] += 1;
+            runAndCount(*task);
+            return True;
+        # otherwise, drop ...
+        with lock:
+            counts["pending"] -= 1;
+            counts["dropped"] += 1;
+            if not counts["pending"]:
+                idle.notify_all();
+        (onError or reportTaskError)(OverflowError("Deferred task queue is full."), fn);
+        return False;
+    pool.submit = submit;
+    
+    def wait (timeout=None):
+        "Waits until no tasks are pending. Returns False on timeout.";
+        with lock:
+            return idle.wait_for(lambda: not counts["pending"], timeout);
+    pool.wait = wait;
+    
+    def getStats ():
+        "Returns task counts.";
+        with lock:
+            return dict(counts);
+    pool.getStats = getStats;
+    
+    return pool;
+
+# Static files: . . . . . . . . . . . . . . . . . . . . . . .
+
+@functools.lru_cache(maxsize=512)
+def guessMimeTypeByExt (ext):
+    "Memoized helper for guessMimeType(.)";
+    mimeType, encoding = mimetypes.guess_type("x" + ext);
+    return mimeType or "application/octet-stream";
+
+def guessMimeType (filepath):
+    "Guesses MIME type of `filepath`, memoized by extension.";
+    return guessMimeTypeByExt(os.path.splitext(filepath)[1].lower());
+
+fileMetaCache = {};     # filepath => (mtime_ns, size, etag, lastModified)
+
+def getFileMeta (filepath, st):
+    "Returns (etag, lastModified) for `filepath`, given its stat `st`.";
+    cached = fileMetaCache.get(filepath);
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2], cached[3];
+    # otherwise ...
+    etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size);
+    lastModified = email.utils.formatdate(st.st_mtime, usegmt=True);
+    if len(fileMetaCache) >= FILE_META_CACHE_SIZE:
+        fileMetaCache.clear();  # Simple bound, avoids unlimited growth.
+    fileMetaCache[filepath] = (st.st_mtime_ns, st.st_size, etag, lastModified);
+    return etag, lastModified;
+
+def checkEtagMatch (ifNoneMatch, etag):
+    "Checks If-None-Match header value against `etag`, weakly.";
+    if ifNoneMatch.strip() == "*":
+        return True;
+    strip = lambda tag: tag.strip().replace("W/", "", 1);
+    target = strip(etag);
+    return any(strip(tag) == target for tag in ifNoneMatch.split(","));
+
+etagModeSet = {"weak", "strong"};
+
+def normalizeEtagMode (mode):
+    "Returns 'weak' (for True), 'strong', or None (for falsy `mode`).";
+    if not mode:
+        return None;
+    mode = "weak" if mode is True else mode;
+    if mode not in etagModeSet:
+        raise ValueError("Unexpected ETag mode %r." % (mode,));
+    return mode;
+
+def mkEtag (key, weak=True):
+    "Makes an ETag by hashing `key`, which may be bytes or str-able.";
+    b_key = key if type(key) is bytes else str(key).encode("utf8");
+    etag = '"%s"' % hashlib.blake2b(b_key, digest_size=16).hexdigest();
+    return "W/" + etag if weak else etag;
+
+def checkNotModified (req, etag, mtime=None):
+    "True if `req` is a conditional request that may be answered with a 304.";
+    ifNoneMatch = req.getHeader("If-None-Match");
+    if ifNoneMatch is not None:
+        return checkEtagMatch(ifNoneMatch, etag);   # Takes precedence.
+    ifModifiedSince = req.getHeader("If-Modified-Since");
+    if ifModifiedSince and mtime is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(ifModifiedSince);
+        except (TypeError, ValueError):
+            return False;
+        return int(mtime) <= since.timestamp();
+    return False;
+
+def parseRangeHeader (rangeHeader, size):
+    "Parses single-range `rangeHeader` into (start, stop).";
+    # Returns None if the header should be ignored (malformed, or
+    # multi-range), and False if the range is unsatisfiable.
+    unit, _, spec = rangeHeader.partition("=");
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None;
+    first, dash, last = spec.strip().partition("-");
+    if not dash or not (first.isdigit() or last.isdigit()):
+        return None;
+    if not first:   # Suffix range, eg: 'bytes=-500'
+        length = int(last);
+        if length == 0 or size == 0:
+            return False;
+        return (max(0, size - length), size);
+    start = int(first);
+    stop = min(int(last) + 1, size) if last.isdigit() else size;
+    if last.isdigit() and int(last) < start:
+        return None;
+    if start >= size:
+        return False;
+    return (start, stop);
+
+def parseAcceptEncoding (header):
+    "Parses Accept-Encoding `header` into a {coding: qvalue} dict.";
+    qMap = {};
+    for item in (header or "").split(","):
+        coding, _, params = item.partition(";");
+        coding = coding.strip().lower();
+        if not coding:
+            continue;
+        q = 1.0;
+        params = params.strip().replace(" ", "");
+        if params.startswith("q="):
+            try:
+                q = float(params[2:]);
+            except ValueError:
+                q = 0.0;
+        qMap[coding] = q;
+    return qMap;
+
+def checkAcceptsEncoding (qMap, coding):
+    "True if `coding` is acceptable, per parsed Accept-Encoding `qMap`.";
+    q = qMap.get(coding, qMap.get("*", 0.0));
+    return q > 0;
+
+# Precompressed siblings, in order of preference:
+staticVariantList = [("br", ".br"), ("gzip", ".gz")];
+
+def scanStaticFile (filepath, mimeType=None):
+    "Builds a static-manifest entry for `filepath`, else None.";
+    try:
+        st = os.stat(filepath);
+    except OSError:
+        return None;
+    if not stat.S_ISREG(st.st_mode):
+        return None;
+    etag, lastModified = getFileMeta(filepath, st);
+    return {
+        "path": filepath, "size": st.st_size, "mtime": st.st_mtime,
+        "mtime_ns": st.st_mtime_ns, "etag": etag,
+        "lastModified": lastModified,
+        "mimeType": mimeType or guessMimeType(filepath),
+        "variants": {},     # coding => entry, for precompressed siblings.
+    };
+
+def addStaticVariants (entry):
+    "Attaches precompressed siblings (.br, .gz) to `entry`, in-place.";
+    entry["variants"] = {};
+    for (coding, ext) in staticVariantList:
+        variant = scanStaticFile(entry["path"] + ext, entry["mimeType"]);
+        if variant:
+            entry["variants"][coding] = variant;
+    return entry;
+
+def buildStaticManifest (directory, includeHidden=False):
+    "Scans `directory` into a {relpath: entry} manifest.";
+    manifest = {};
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        if not includeHidden:
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")];
+        for filename in filenames:
+            if filename.startswith(".") and not includeHidden:
+                continue;
+            filepath = os.path.join(dirpath, filename);
+            entry = scanStaticFile(filepath);
+            if entry:
+                relpath = os.path.relpath(filepath, directory);
+                manifest[relpath.replace(os.sep, "/")] = entry;
+    for entry in manifest.values():
+        addStaticVariants(entry);
+    return manifest;
+
+class FileBody (object):
+    "Handler output for (a byte-range of) an open file.";
+    # Returned by `res.staticFile(.)`. In `_finish`, whole files are
+    # handed to environ['wsgi.file_wrapper'], if available, so that
+    # servers may use `sendfile`. Else, the file is streamed in blocks.
+    __slots__ = ("file", "offset", "length", "isWhole");
+    
+    def __init__ (self, file, offset, length, isWhole):
+        self.file = file;
+        self.offset = offset;
+        self.length = length;
+        self.isWhole = isWhole;
+    
+    def iterBlocks (self, blksize=FILE_BLOCK_SIZE):
+        "Yields blocks of the file's (byte-range) content.";
+        self.file.seek(self.offset);
+        remaining = self.length;
+        while remaining > 0:
+            block = self.file.read(min(blksize, remaining));
+            if not block:
+                break;
+            remaining -= len(block);
+            yield block;
+
+# Compression: . . . . . . . . . . . . . . . . . . . . . . .
+
+COMPRESSION_LEVEL = 6;
+COMPRESSION_MIN_SIZE = 1 * KB;
+
+compressibleMimeTypeSet = {
+    "application/json", "application/javascript", "application/xml",
+    "application/x-javascript", "application/xhtml+xml",
+    "application/rss+xml", "application/atom+xml", "image/svg+xml",
+};
+
+def checkCompressibleMimeType (contentType):
+    "True if `contentType` is worth compressing (i.e. not already compressed).";
+    mimeType = (contentType or "").split(";")[0].strip().lower();
+    return (mimeType.startswith("text/") or
+        mimeType in compressibleMimeTypeSet or
+        mimeType.endswith("+json") or mimeType.endswith("+xml")   #or
+    );
+
+compressionWbitsMap = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS};
+
+def mkCompressor (coding, level):
+    "Makes a zlib compressor for `coding` ('gzip' or 'deflate').";
+    return zlib.compressobj(level, zlib.DEFLATED, compressionWbitsMap[coding]);
+
+def pickCompressionCoding (acceptEncoding):
+    "Picks 'gzip' or 'deflate' as per `acceptEncoding` header, else None.";
+    qMap = parseAcceptEncoding(acceptEncoding);
+    for coding in ["gzip", "deflate"]:
+        if checkAcceptsEncoding(qMap, coding):
+            return coding;
+    return None;
+
+class Response (object):
+    "Slotted response object, built per request.";
+    __slots__ = (
+        "statusLine", "contentType", "_headerMap", "_cookieJar",
+        "_contentLength", "_compression", "_jsonCodec", "app", "request",
+        "_start_response", "_deferList", "_releaseList", "_etagMode",
+        "__dict__",     # Allocated only if a plugin adds attrs.
+    );
+    
+    def __init__ (self, start_response):
+        self.statusLine = "200 OK";
+        self.contentType = "text/html; charset=UTF-8";
+        self._headerMap = {};
+        self._cookieJar = _UNSET;
+        self._contentLength = None;     # Only for streamed bodies.
+        self._compression = None;       # Set by app, if enabled.
+        self._jsonCodec = stdJsonCodec; # Set by app.
+        self.app = None;
+        self.request = None;
+        self._start_response = start_response;
+        self._deferList = None;         # Allocated on first `.defer(.)`
+        self._releaseList = None;       # Held limiters' release fns, if any.
+        self._etagMode = None;          # Set by app, if auto-ETags are enabled.
+    
+    def _computeCookieJar (self):
+        "Response cookies, a `SimpleCookie`.";
+        return http.cookies.SimpleCookie();
+    cookieJar = mkLazyProperty("_cookieJar", _computeCookieJar);
+    
+    def bindApp (self, appObject, reqObject):
+        self.app = appObject;
+        self.request = reqObject;
+    
+    def setHeader (self, name, value):
         name = name.strip().upper();
         if name == "CONTENT-TYPE":
-            res.contentType = value;
+            self.contentType = value;
         elif name == "CONTENT-LENGTH":
-            raise Exception("The Content-Length header will be automatically set.");
+            # Auto-set for regular bodies, but may be set for streamed ones.
+            self._contentLength = str(int(value));
         else:
-            res._headerMap[name] = value; # TODO: str(value)?
-    res.setHeader = setHeader;
+            self._headerMap[name] = value; # TODO: str(value)?
     
-    def getHeader (name):
-        return res._headerMap.get(name.strip().upper());
-    res.getHeader = getHeader;
+    def getHeader (self, name):
+        return self._headerMap.get(name.strip().upper());
     
-    def setHeaders (headerList):
+    def setHeaders (self, headerList):
         if type(headerList) is dict:
             headerList = list(headerList.items());
         assert type(headerList) is list;
-        mapli(headerList, lambda pair: setHeader(*pair));
-    res.setHeaders = setHeaders;
+        for pair in headerList:
+            self.setHeader(*pair);
     
-    def setUnsignedCookie (name, value, opt=None):
+    def setUnsignedCookie (self, name, value, opt=None):
         assert type(value) is str;
-        res.cookieJar[name] = value;
-        morsel = res.cookieJar[name]
+        self.cookieJar[name] = value;
+        morsel = self.cookieJar[name]
         assert type(morsel) is http.cookies.Morsel;
         opt = opt or {};
         dictDefaults(opt, {
@@ -375,75 +1273,509 @@ def buildResponse (start_response):
         for optKey, optVal in opt.items():
             morsel[optKey] = optVal;
         return value;   # `return` helps w/ testing.
-    res.setUnsignedCookie = setUnsignedCookie;
-
-    def setCookie (name, value, secret=None, opt=None):
+    
+    def setCookie (self, name, value, secret=None, opt=None):
         uVal = signWrap(value, secret) if secret else value;    # Unsigned-ready val.
-        setUnsignedCookie(name, uVal, opt);
+        self.setUnsignedCookie(name, uVal, opt);
         return uVal;    # `return` helps w/ testing.
-    res.setCookie = setCookie;
     
-    #def getCookie (name, value):
+    #def getCookie (self, name, value):
     #    pass; # ??? For getting just-res-set cookies.
-    #res.getCookie = getCookie;
     
-    def staticFile (filepath, mimeType=None):
-        if not mimeType:
-            mimeType, encoding = mimetypes.guess_type(filepath);
-            mimeType = mimeType or  "application/octet-stream";
+    def staticFile (self, filepath, mimeType=None):
+        "Serves `filepath`, with conditional GET & Range support.";
+        notFound = lambda: HttpError("<h2>File Not Found<h2>", 404, "file_not_found");
         try:
-            with open(filepath, "rb") as f:
-                res.contentType = mimeType;
-                return f.read();
-        except IOError:
-            raise HttpError("<h2>File Not Found<h2>", 404, "file_not_found");
-    res.staticFile = staticFile;
-    
-    def redirect (url):
-        res.statusLine = "302 Found";                       # Better to use '303 See Other' for HTTP/1.1 environ['SERVER_PROTOCOL']
-        res.setHeader("Location", url);                     # but 302 is backward compataible, and doesn't need access to req object.
+            st = os.stat(filepath);
+        except OSError:
+            raise notFound();
+        if not stat.S_ISREG(st.st_mode):
+            raise notFound();
+        # otherwise ...
+        etag, lastModified = getFileMeta(filepath, st);
+        return self._serveFile(
+            filepath, st.st_size, st.st_mtime, etag, lastModified,
+            mimeType or guessMimeType(filepath),
+        );
+    
+    def setEtag (self, key, weak=True):
+        "Sets ETag from version `key`. Returns True (& sets 304/412) if If-None-Match matches.";
+        # Call before the costly work, and if True, `return ""`.
+        # For GET/HEAD, a match means the client's copy is fresh (304).
+        # For other verbs, it's a failed precondition (412).
+        etag = mkEtag(key, weak);
+        self._headerMap["ETAG"] = etag;
+        req = self.request;
+        ifNoneMatch = req.getHeader("If-None-Match") if req is not None else None;
+        if ifNoneMatch is None or not checkEtagMatch(ifNoneMatch, etag):
+            return False;
+        # otherwise ...
+        if req.getVerb() in ["GET", "HEAD"]:
+            self.statusLine = "304 Not Modified";
+        else:
+            self.statusLine = "412 Precondition Failed";
+        return True;
+    
+    def _weakenEtag (self):
+        "Weakens a strong ETag, as compression (on the fly) changes the bytes.";
+        etag = self._headerMap.get("ETAG");
+        if etag and not etag.startswith("W/"):
+            self._headerMap["ETAG"] = "W/" + etag;
+    
+    def _applyAutoEtag (self, bBody):
+        "Sets ETag by hashing `bBody`. Returns `bBody`, or b'' if 304.";
+        req = self.request;
+        if req is None or req.getVerb() not in ["GET", "HEAD"]:
+            return bBody;
+        if self.setEtag(bBody, self._etagMode == "weak"):
+            return b"";
+        return bBody;
+    
+    def _serveFile (self, filepath, size, mtime, etag, lastModified, mimeType, data=None):
+        "Helper. Serves already-stat'd `filepath`, or in-memory `data`.";
+        notFound = lambda: HttpError("<h2>File Not Found<h2>", 404, "file_not_found");
+        self.contentType = mimeType;
+        self._compression = None;   # As-is, so `etag` matches the bytes sent.
+        self._headerMap["ETAG"] = etag;
+        self._headerMap["LAST-MODIFIED"] = lastModified;
+        self._headerMap["ACCEPT-RANGES"] = "bytes";
+        req = self.request;
+        if req is not None and checkNotModified(req, etag, mtime):
+            self.statusLine = "304 Not Modified";
+            return b"";
+        offset, length = 0, size;
+        rangeHeader = req.getHeader("Range") if req is not None else None;
+        ifRange = req.getHeader("If-Range") if rangeHeader else None;
+        if rangeHeader and ifRange in [None, etag, lastModified]:
+            byteRange = parseRangeHeader(rangeHeader, size);
+            if byteRange is False:
+                self.statusLine = "416 Range Not Satisfiable";
+                self._headerMap["CONTENT-RANGE"] = "bytes */%d" % size;
+                return b"";
+            if byteRange:
+                offset, length = byteRange[0], byteRange[1] - byteRange[0];
+                self.statusLine = "206 Partial Content";
+                self._headerMap["CONTENT-RANGE"] = "bytes %d-%d/%d" % (
+                    offset, offset + length - 1, size,
+                );
+        if data is not None:
+            return data if length == size else data[offset : offset + length];
+        try:
+            f = open(filepath, "rb");
+        except OSError:
+            raise notFound();
+        return FileBody(f, offset, length, length == size);
+    
+    def defer (self, fn, *args, **kwargs):
+        "Schedules `fn(*args, **kwargs)` to run after the response is sent.";
+        if self._deferList is None:
+            self._deferList = [];
+        self._deferList.append((fn, args, kwargs));
+    
+    def _wrapDeferred (self, body):
+        "Returns `body`, arranging for deferred tasks upon its `.close()`.";
+        taskList, self._deferList = self._deferList, None;
+        if self.app is not None:
+            submit = self.app.deferPool.submit;
+        else:
+            submit = lambda fn, args, kwargs: runTask(fn, args, kwargs, None);
+        stream = body if isinstance(body, ResponseStream) else ResponseStream(body);
+        stream.addCloseHook(lambda: [submit(*task) for task in taskList]);
+        return stream;
+    
+    def _wrapReleases (self, body):
+        "Returns `body`, arranging for held limiters' release once it's done.";
+        releaseList, self._releaseList = self._releaseList, None;
+        if isinstance(body, ResponseStream):
+            for release in releaseList:
+                body.addCloseHook(release);
+            return body;
+        # otherwise, body is already produced ...
+        for release in releaseList:
+            release();
+        return body;
+    
+    def redirect (self, url):
+        self.statusLine = "302 Found";                      # Better to use '303 See Other' for HTTP/1.1 environ['SERVER_PROTOCOL']
+        self.setHeader("Location", url);                    # but 302 is backward compataible, and doesn't need access to req object.
         return b"";
-    res.redirect = redirect;
-
     
-    def _bytify (x):
+    def _bytify (self, x):
         if type(x) is str:
             return x.encode("utf8");
         if type(x) is bytes:
             return x;
         if isinstance(x, (dict, list)):
-            res.contentType = "application/json";
-            return json.dumps(x).encode("utf8");            # ? latin1 ?
+            self.contentType = "application/json";
+            return self._jsonCodec.encode(x);
         # otherwise ...
         return str(x).encode("utf8");
     
-    def _finish (handlerOut):
-        bBody = _bytify(handlerOut);
-        headerList = (
-            list(res._headerMap.items()) +
-            mapli(
-                res.cookieJar.values(),            
-                lambda m: ("SET-COOKIE", m.OutputString()),
-            ) +
-            list({
-                "CONTENT-TYPE": res.contentType,
-                "CONTENT-LENGTH": str(len(bBody)),
-            }.items()) #+
+    def _wrapFileBody (self, fileBody):
+        "Returns WSGI iterable for `fileBody`.";
+        environ = self.request.getEnviron() if self.request is not None else {};
+        fileWrapper = environ.get("wsgi.file_wrapper");
+        if fileBody.isWhole and fileWrapper:
+            return fileWrapper(fileBody.file, FILE_BLOCK_SIZE);
+        # otherwise ...
+        stream = ResponseStream(fileBody.iterBlocks());
+        stream.addCloseHook(fileBody.file.close);
+        return stream;
+    
+    def _pickCompression (self, bodySize=None):
+        "Returns coding to compress with (eg 'gzip'), else None.";
+        compression = self._compression;
+        if (compression is None or
+            self.statusLine[:3] in ["204", "206", "304"] or
+            "CONTENT-ENCODING" in self._headerMap or
+            (bodySize is not None and bodySize < compression["minSize"]) or
+            not checkCompressibleMimeType(self.contentType)    #or
+        ):
+            return None;
+        # otherwise ...
+        vary = self._headerMap.get("VARY");
+        if not vary:
+            self._headerMap["VARY"] = "Accept-Encoding";
+        elif "accept-encoding" not in vary.lower() and vary.strip() != "*":
+            self._headerMap["VARY"] = vary + ", Accept-Encoding";
+        if self.request is None:
+            return None;
+        return pickCompressionCoding(self.request.getHeader("Accept-Encoding"));
+    
+    def _dropBody (self, body):
+        "For HEAD requests, closes `body` and returns an empty one.";
+        if hasattr(body, "close"):
+            body.close();
+        return [];
+    
+    def _finish (self, handlerOut):
+        if type(handlerOut) is FileBody:
+            body = self._wrapFileBody(handlerOut);
+            contentLength = str(handlerOut.length);
+        elif isStreamBody(handlerOut):
+            body = ResponseStream(handlerOut);
+            contentLength = self._contentLength;    # None => Omitted.
+            coding = self._pickCompression();
+            if coding:
+                level = self._compression["level"];
+                compressor = mkCompressor(coding, level);
+                body.addFilter(compressor.compress, compressor.flush);
+                self._headerMap["CONTENT-ENCODING"] = coding;
+                self._weakenEtag();
+                contentLength = None;   # Unknown, post compression.
+        else:
+            bBody = self._bytify(handlerOut);
+            if (self._etagMode is not None and
+                self.statusLine[:3] == "200" and "ETAG" not in self._headerMap
+            ):
+                bBody = self._applyAutoEtag(bBody);
+            coding = self._pickCompression(len(bBody));
+            if coding:
+                compressor = mkCompressor(coding, self._compression["level"]);
+                bCompressed = compressor.compress(bBody) + compressor.flush();
+                if len(bCompressed) < len(bBody):
+                    bBody = bCompressed;
+                    self._headerMap["CONTENT-ENCODING"] = coding;
+                    self._weakenEtag();
+            body = [bBody];
+            contentLength = str(len(bBody));
+        if self.request is not None and self.request.getVerb() == "HEAD":
+            if contentLength == "0" and self._contentLength is not None:
+                contentLength = self._contentLength;    # Handler skipped body.
+            body = self._dropBody(body);
+        headerMap = self._headerMap;
+        # App-level default headers are pre-encoded, see app.setDefaultHeaders(.)
+        defaultHeaders = self.app.defaultHeaders if self.app is not None else ();
+        latin1_headerList = [
+            pair for pair in defaultHeaders if pair[0] not in headerMap
+        ];
+        for (name, value) in headerMap.items():
+            latin1_headerList.append((name, headerToLatin1(value)));
+        if self._cookieJar is not _UNSET:
+            for morsel in self._cookieJar.values():
+                latin1_headerList.append(
+                    ("SET-COOKIE", headerToLatin1(morsel.OutputString())),
+                );
+        latin1_headerList.append(
+            ("CONTENT-TYPE", headerToLatin1(self.contentType)),
         );
-        #print("res.statusLine = ", res.statusLine);
-        #pprint.pprint(headerList);
-        latin1_headerList = [];
-        for (name, value) in headerList:
-            latin1_headerList.append((name, utf8_to_latin1(value)));
+        if contentLength is not None and self.statusLine[:3] not in ["204", "304"]:
+            latin1_headerList.append(("CONTENT-LENGTH", contentLength));
         #pprint.pprint(latin1_headerList);
-        start_response(
-            utf8_to_latin1(res.statusLine), latin1_headerList,
+        self._start_response(
+            statusLineToLatin1(self.statusLine), latin1_headerList,
+        );
+        return body;
+
+def buildResponse (start_response):
+    "Builds a `Response` object around `start_response`.";
+    return Response(start_response);
+
+############################################################
+# Admission Control: #######################################
+############################################################
+
+# Admission runs before the body is read. Rate limiters, which
+# keep a token bucket per client key, are checked before route
+# matching. Limiters, checked after it, cap in-flight requests
+# (app-wide & per-route), letting a bounded number of requests
+# wait briefly for a slot. Rejections
+# are plain HttpErrors, with fwCodes "service_overloaded" (503)
+# and "rate_limited" (429), handled like any framework error.
+
+RATE_LIMIT_MAX_CLIENTS = 10000;
+
+def buildLimiter (maxInFlight, maxQueue=None):
+    "Builds a limiter, capping in-flight requests at `maxInFlight`.";
+    # At most `maxQueue` (default: `maxInFlight`) callers may wait.
+    assert type(maxInFlight) is int and maxInFlight > 0;
+    maxQueue = maxInFlight if maxQueue is None else maxQueue;
+    limiter = dotsi.fy({"maxInFlight": maxInFlight, "maxQueue": maxQueue});
+    lock = threading.Lock();
+    vacancy = threading.Condition(lock);
+    counts = {"inFlight": 0, "waiting": 0, "admitted": 0, "queued": 0, "rejected": 0};
+    hasVacancy = lambda: counts["inFlight"] < maxInFlight;
+    
+    def acquire (timeout=0):
+        "Takes a slot, waiting up to `timeout` secs. Returns False if none.";
+        with lock:
+            if counts["inFlight"] < maxInFlight:
+                counts["inFlight"] += 1;
+                counts["admitted"] += 1;
+                return True;
+            if timeout <= 0 or counts["waiting"] >= maxQueue:
+                counts["rejected"] += 1;
+                return False;
+            # otherwise ...
+            counts["waiting"] += 1;
+            ok = vacancy.wait_for(hasVacancy, timeout);
+            counts["waiting"] -= 1;
+            if not ok:
+                counts["rejected"] += 1;
+                return False;
+            counts["inFlight"] += 1;
+            counts["admitted"] += 1;
+            counts["queued"] += 1;
+            return True;
+    limiter.acquire = acquire;
+    
+    def release ():
+        "Returns a slot taken via `.acquire(.)`";
+        with lock:
+            counts["inFlight"] -= 1;
+            vacancy.notify();
+    limiter.release = release;
+    
+    def getStats ():
+        "Returns in-flight/waiting gauges, and admission counts.";
+        with lock:
+            return dict(counts);
+    limiter.getStats = getStats;
+    
+    return limiter;
+
+def buildRateLimiter (rate, burst=None, maxClients=RATE_LIMIT_MAX_CLIENTS):
+    "Builds a per-client token-bucket limiter, `rate` requests/sec.";
+    # Each bucket holds up to `burst` (default: `rate`) tokens. Only
+    # the `maxClients` most recently seen keys are remembered (LRU).
+    assert rate > 0;
+    burst = max(1, rate if burst is None else burst);
+    rateLimiter = dotsi.fy({"rate": rate, "burst": burst, "maxClients": maxClients});
+    lock = threading.Lock();
+    bucketMap = collections.OrderedDict();  # key => (tokens, stamp)
+    counts = {"allowed": 0, "limited": 0};
+    
+    def check (key):
+        "Takes a token for `key`. Returns 0 if ok, else secs to wait.";
+        now = time.monotonic();
+        with lock:
+            bucket = bucketMap.pop(key, None);
+            if bucket is None:
+                tokens = burst;
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate);
+            if tokens >= 1:
+                tokens -= 1;
+                wait = 0;
+                counts["allowed"] += 1;
+            else:
+                wait = (1 - tokens) / rate;
+                counts["limited"] += 1;
+            bucketMap[key] = (tokens, now);
+            if len(bucketMap) > maxClients:
+                bucketMap.popitem(last=False);
+        return wait;
+    rateLimiter.check = check;
+    
+    def getStats ():
+        "Returns allowed/limited counts, and number of tracked clients.";
+        with lock:
+            return dict(counts, clients=len(bucketMap));
+    rateLimiter.getStats = getStats;
+    
+    return rateLimiter;
+
+def getClientAddr (req):
+    "Default rate-limiting key, the client's IP address.";
+    return req.getEnviron().get("REMOTE_ADDR");
+
+############################################################
+# Sessions: ################################################
+############################################################
+
+# The session cookie holds only a signed session ID; the data
+# lives in a store. Stores have `load(sid)`, returning a dict
+# (else None), `save(sid, data, ttl)` and `delete(sid)`. Data
+# is JSON-encoded, so it behaves the same across stores.
+
+SESSION_COOKIE_NAME = "vilo_session";
+SESSION_TTL = 14 * 24 * 3600;       # Secs, since last write.
+SESSION_MAX_COUNT = 10000;          # For the in-memory store.
+SESSION_SQLITE_TIMEOUT = 5;         # Secs, to wait for a locked DB.
+
+def mkSessionId ():
+    "Returns a new, random session ID.";
+    return toStr(base64.urlsafe_b64encode(os.urandom(24)));
+
+class Session (dict):
+    "Session data, a dict that tracks whether it's been modified.";
+    # Only top-level changes are tracked. After mutating a nested
+    # value in place, set `.modified = True` (or reassign it).
+    __slots__ = ("sid", "modified", "_regenerate", "_invalidate");
+    
+    def __init__ (self, sid=None, data=None):
+        dict.__init__(self, data or {});
+        self.sid = sid;                 # None, if not yet saved.
+        self.modified = False;
+        self._regenerate = False;
+        self._invalidate = False;
+    
+    def _mkMutator (name):
+        method = getattr(dict, name);
+        def mutator (self, *args, **kwargs):
+            self.modified = True;
+            return method(self, *args, **kwargs);
+        mutator.__name__ = name;
+        return mutator;
+    __setitem__ = _mkMutator("__setitem__");
+    __delitem__ = _mkMutator("__delitem__");
+    clear = _mkMutator("clear");
+    pop = _mkMutator("pop");
+    popitem = _mkMutator("popitem");
+    setdefault = _mkMutator("setdefault");
+    update = _mkMutator("update");
+    del _mkMutator;
+    
+    def regenerate (self):
+        "Issues a new session ID, keeping data. Use upon login.";
+        self._regenerate = True;
+        self.modified = True;
+    
+    def invalidate (self):
+        "Clears the session, deleting it from the store. Use upon logout.";
+        dict.clear(self);
+        self._invalidate = True;
+        self.modified = True;
+
+def buildMemorySessionStore (maxCount=SESSION_MAX_COUNT, codec=stdJsonCodec):
+    "Builds an in-process session store, holding up to `maxCount` (LRU).";
+    # Not shared across processes; see buildSqliteSessionStore(.)
+    store = dotsi.fy({"maxCount": maxCount});
+    entryMap = collections.OrderedDict();   # sid => (expiresAt, b_json)
+    lock = threading.Lock();
+    
+    def load (sid):
+        "Returns data for `sid`, else None if missing or expired.";
+        with lock:
+            entry = entryMap.get(sid);
+            if entry is None:
+                return None;
+            if entry[0] < time.time():
+                del entryMap[sid];
+                return None;
+            entryMap.move_to_end(sid);
+        return codec.decode(entry[1]);
+    store.load = load;
+    
+    def save (sid, data, ttl):
+        "Saves `data` for `sid`, expiring after `ttl` secs.";
+        entry = (time.time() + ttl, codec.encode(data));
+        with lock:
+            entryMap[sid] = entry;
+            entryMap.move_to_end(sid);
+            while len(entryMap) > maxCount:
+                entryMap.popitem(last=False);
+    store.save = save;
+    
+    def delete (sid):
+        "Deletes session `sid`, if any.";
+        with lock:
+            entryMap.pop(sid, None);
+    store.delete = delete;
+    
+    def getStats ():
+        "Returns number of stored (incl. expired, unpurged) sessions.";
+        with lock:
+            return {"sessions": len(entryMap)};
+    store.getStats = getStats;
+    
+    return store;
+
+def buildSqliteSessionStore (path, codec=stdJsonCodec, timeout=SESSION_SQLITE_TIMEOUT):
+    "Builds a session store in SQLite file `path`, shared across processes.";
+    import sqlite3;     # Lazily, as some Python builds lack it.
+    store = dotsi.fy({"path": path});
+    local = threading.local();  # Per-thread connection.
+    
+    def getConn ():
+        # Connections don't survive fork(.), so (re)open per process.
+        pid = os.getpid();
+        if getattr(local, "pid", None) != pid:
+            conn = sqlite3.connect(path, timeout=timeout, isolation_level=None);
+            conn.execute("PRAGMA journal_mode=WAL");
+            conn.execute("""CREATE TABLE IF NOT EXISTS vilo_session (
+                sid TEXT PRIMARY KEY, data BLOB NOT NULL, expiresAt REAL NOT NULL
+            )""");
+            local.conn, local.pid = conn, pid;
+        return local.conn;
+    
+    def load (sid):
+        "Returns data for `sid`, else None if missing or expired.";
+        row = getConn().execute(
+            "SELECT data FROM vilo_session WHERE sid = ? AND expiresAt >= ?",
+            (sid, time.time()),
+        ).fetchone();
+        return None if row is None else codec.decode(bytes(row[0]));
+    store.load = load;
+    
+    def save (sid, data, ttl):
+        "Saves `data` for `sid`, expiring after `ttl` secs.";
+        getConn().execute(
+            "INSERT OR REPLACE INTO vilo_session VALUES (?, ?, ?)",
+            (sid, codec.encode(data), time.time() + ttl),
         );
-        return [bBody];
-    res._finish = _finish;
+    store.save = save;
     
-    # Return built `res`:
-    return res;
+    def delete (sid):
+        "Deletes session `sid`, if any.";
+        getConn().execute("DELETE FROM vilo_session WHERE sid = ?", (sid,));
+    store.delete = delete;
+    
+    def purgeExpired ():
+        "Deletes expired sessions. Returns count deleted.";
+        cursor = getConn().execute(
+            "DELETE FROM vilo_session WHERE expiresAt < ?", (time.time(),),
+        );
+        return cursor.rowcount;
+    store.purgeExpired = purgeExpired;
+    
+    def getStats ():
+        "Returns number of stored (incl. expired, unpurged) sessions.";
+        (count,) = getConn().execute("SELECT COUNT(*) FROM vilo_session").fetchone();
+        return {"sessions": count};
+    store.getStats = getStats;
+    
+    return store;
 
 ############################################################
 # Routing: #################################################
@@ -470,15 +1802,37 @@ def validateWildcardPath (wPath):
     # otherwise ...
     return True;
 
-def buildRoute(verb, path, fn, mode=None, name=None):
+routeOptDefaults = {
+    "maxBodySize": None,    # Per-route body size limit, if any.
+    "maxPartSize": None,    # Per-route multipart part size limit, if any.
+    "compress": None,       # True/False, or None to follow app.setCompression(.)
+    "cache": None,          # TTL (secs), or dict; see normalizeCacheOpt(.)
+    "decodeBody": True,     # If False, req.fdata is empty; use req.bodyBytes etc.
+    "fullMatch": False,     # For re-mode routes, re.fullmatch(.) vs re.match(.)
+    "maxInFlight": None,    # Per-route concurrency cap, see buildLimiter(.)
+    "etag": None,           # "weak"/"strong"/True/False, or None to follow app.setAutoEtag(.)
+};
+
+def buildRoute(verb, path, fn, mode=None, name=None, **opt):
     verb = [verb] if type(verb) is str else verb;
     mode = detectRouteMode(path) if not mode else mode;
     assert mode in ["re", "wildcard", "exact"];
     if mode == "wildcard":
         assert validateWildcardPath(path);
+    for optKey in opt:
+        if optKey not in routeOptDefaults:
+            raise TypeError("Unexpected route option %r." % optKey);
+    dictDefaults(opt, routeOptDefaults);
+    if opt["etag"] is not None:
+        normalizeEtagMode(opt["etag"]);     # Validates, early.
     return dotsi.fy({
         "verb": verb,  "path": path,  "fn": fn,
-        "mode": mode,  "name": name,
+        "mode": mode,  "name": name,  "opt": opt,
+        "_pfn": None,   # Plugged fn, cached by app.
+        "_cacheOpt": normalizeCacheOpt(opt["cache"]),
+        "_rex": re.compile(path) if mode == "re" else None,
+        "_urlTemplate": None,   # Compiled lazily, see mkUrlTemplate(.)
+        "_limiter": buildLimiter(opt["maxInFlight"]) if opt["maxInFlight"] else None,
     });
 
 def checkWildcardMatch (wPath, aPath, req):
@@ -509,8 +1863,9 @@ def checkWildcardMatch (wPath, aPath, req):
     req.wildcards = wildcards;
     return True;
 
-def checkReMatch (rePath, aPath, req):
-    m = re.match(rePath, aPath);
+def checkReMatch (rePath, aPath, req, fullMatch=False):
+    rex = re.compile(rePath) if type(rePath) is str else rePath;
+    m = rex.fullmatch(aPath) if fullMatch else rex.match(aPath);
     if not m:
         return False;
     # otherwise ...
@@ -524,7 +1879,674 @@ def checkRouteMatch (route, req):
         return route.path == aPath;
     if route.mode == "wildcard":
         return checkWildcardMatch(route.path, aPath, req);
-    return checkReMatch(route.path, aPath, req);
+    return checkReMatch(route._rex, aPath, req, route.opt.fullMatch);
+
+# Reverse routing: :::::::::::::::::::::::::::::::::::::::::
+
+reLiteralEscapeSet = set("\\.^$*+?{}[]|()/-#&~ ");
+
+def mkReUrlTemplate (rePath):
+    "Returns `%`-format template from `rePath`, one `%s` per group.";
+    # Only literal chars, escaped literals & top-level capturing
+    # groups can be reversed. Anchors (^, $, \Z) are dropped.
+    err = lambda: ValueError("Can't build URLs from pattern %r." % rePath);
+    fmt, n, i = "", 0, 0;
+    if rePath.startswith("^"):
+        i = 1;
+    while i < len(rePath):
+        c = rePath[i];
+        if c == "\\":
+            nc = rePath[i+1 : i+2];
+            if nc == "Z" and i + 2 == len(rePath):
+                break;
+            if nc not in reLiteralEscapeSet:
+                raise err();
+            fmt += nc.replace("%", "%%");
+            i += 2;
+        elif c == "(":
+            if rePath.startswith("(?", i) and not rePath.startswith("(?P<", i):
+                raise err();    # Non-capturing, lookaround, flags etc.
+            depth, j = 0, i;
+            while j < len(rePath):
+                if rePath[j] == "\\":
+                    j += 2;
+                    continue;
+                depth += {"(": 1, ")": -1}.get(rePath[j], 0);
+                if depth == 0:
+                    break;
+                j += 1;
+            fmt += "%s";
+            n += 1;
+            i = j + 1;
+        elif c == "$" and i + 1 == len(rePath):
+            break;
+        elif c in ".^$*+?{}[]|)":
+            raise err();
+        else:
+            fmt += c.replace("%", "%%");
+            i += 1;
+    return fmt, n;
+
+def mkUrlTemplate (route):
+    "Returns (fmt, safeList): `%`-format path template & quoting per slot.";
+    if route.mode == "exact":
+        return route.path.replace("%", "%%"), [];
+    if route.mode == "wildcard":
+        segList, safeList = [], [];
+        for seg in route.path.split("/"):
+            if seg in ["*", "**"]:
+                segList.append("%s");
+                safeList.append("/" if seg == "**" else "");
+            else:
+                segList.append(seg.replace("%", "%%"));
+        return "/".join(segList), safeList;
+    # otherwise ...
+    fmt, n = mkReUrlTemplate(route.path);
+    return fmt, [""] * n;
+
+# Compiled dispatch: :::::::::::::::::::::::::::::::::::::::
+#
+# Instead of scanning `app.routeList` route by route, exact
+# and wildcard routes are compiled into a per-verb segment
+# trie, while re-mode routes are kept in a per-verb fallback
+# list. Each route remembers its `routeList` index, and the
+# lowest matching index wins. Thus, first-match-wins ordering
+# (incl. `top=True` insertion) is preserved across all modes.
+#
+# Further, consecutive re-mode routes (per verb) are merged
+# into a single alternation: `(pat0)|(pat1)|...`. As Python's
+# `re` tries alternatives left-to-right, the first matching
+# alternative is the lowest-indexed matching route. It's then
+# identified via `m.lastindex`, as its wrapping group closes
+# last. Patterns with global flags (eg. `(?i)`) or numbered
+# backrefs (which'd shift) aren't merged, and stand alone.
+
+RE_GROUP_MAX_SIZE = 100;    # Max routes per merged alternation.
+reDefaultFlags = re.compile("").flags;
+reNumberedRefPattern = re.compile(r"\\[1-9]|\(\?\(\d");  # Backref/conditional
+
+def checkReMergeable (route):
+    "True if `route`'s pattern can be merged into an alternation.";
+    return (
+        route._rex.flags == reDefaultFlags and
+        not reNumberedRefPattern.search(route.path)
+    );
+
+def mkReGroup (entryList):
+    "Merges (index, route) entries into a single alternation.";
+    if len(entryList) == 1:
+        return {"firstIndex": entryList[0][0], "rex": None, "only": entryList[0]};
+    # otherwise ...
+    altList = [];
+    groupMap = {};  # wrapping group number => (index, route)
+    groupNum = 1;
+    for (index, route) in entryList:
+        alt = "(?:%s)\\Z" % route.path if route.opt.fullMatch else route.path;
+        altList.append("(%s)" % alt);
+        groupMap[groupNum] = (index, route);
+        groupNum += 1 + route._rex.groups;
+    return {
+        "firstIndex": entryList[0][0],
+        "rex": re.compile("|".join(altList)),
+        "groupMap": groupMap,
+    };
+
+def buildReGroupList (reList):
+    "Splits `reList` into runs of mergeable routes, via mkReGroup(.)";
+    groupList = [];
+    run, nameSet = [], set();
+    for (index, route) in reList:
+        mergeable = checkReMergeable(route);
+        nameSubset = set(route._rex.groupindex);    # Named groups
+        if run and (
+            not mergeable or (nameSubset & nameSet) or len(run) >= RE_GROUP_MAX_SIZE
+        ):
+            groupList.append(mkReGroup(run));
+            run, nameSet = [], set();
+        run.append((index, route));
+        nameSet |= nameSubset;
+        if not mergeable:
+            groupList.append(mkReGroup(run));   # Alone.
+            run, nameSet = [], set();
+    if run:
+        groupList.append(mkReGroup(run));
+    return groupList;
+
+INF_INDEX = float("inf");
+
+def mkTrieNode ():
+    "Makes a blank trie node. (Plain dict, for speed.)";
+    return {
+        "lit": {},          # Literal segment => child node.
+        "star": None,       # Child node for '*' segments.
+        "end": INF_INDEX,   # Index of route ending here.
+        "dstar": INF_INDEX, # Index of route ending in '**' here.
+        "min": INF_INDEX,   # Min index within this subtree.
+    };
+
+def insertTrieRoute (root, route, index):
+    "Inserts exact/wildcard `route` (at `index`) into `root`.";
+    segLi = route.path.split("/");
+    isWildcard = route.mode == "wildcard";
+    node = root;
+    node["min"] = min(node["min"], index);
+    for (i, seg) in enumerate(segLi):
+        if isWildcard and seg == "**":
+            assert i == len(segLi) - 1;
+            node["dstar"] = min(node["dstar"], index);
+            return None;
+        if isWildcard and seg == "*":
+            if node["star"] is None:
+                node["star"] = mkTrieNode();
+            node = node["star"];
+        else:
+            if seg not in node["lit"]:
+                node["lit"][seg] = mkTrieNode();
+            node = node["lit"][seg];
+        node["min"] = min(node["min"], index);
+    node["end"] = min(node["end"], index);
+    return None;
+
+def searchTrie (node, segLi, i, wildcards, best):
+    "Finds lowest-index match under `node`, updating `best`.";
+    # `best` is a 2-list: [bestIndex, bestWildcards].
+    if node["min"] >= best[0]:
+        return None;    # Prune, nothing better here.
+    if i == len(segLi):
+        if node["end"] < best[0]:
+            best[0], best[1] = node["end"], list(wildcards);
+        return None;
+    # otherwise ...
+    if node["dstar"] < best[0]:
+        rest = "/".join(segLi[i:]);
+        if rest:                                            # ** doesn't match ''
+            best[0], best[1] = node["dstar"], wildcards + [rest];
+    seg = segLi[i];
+    litChild = node["lit"].get(seg);
+    if litChild is not None:
+        searchTrie(litChild, segLi, i + 1, wildcards, best);
+    if node["star"] is not None and seg:                   # * doesn't match ''
+        wildcards.append(seg);
+        searchTrie(node["star"], segLi, i + 1, wildcards, best);
+        wildcards.pop();
+    return None;
+
+def buildDispatcher (routeList):
+    "Compiles `routeList` into a verb-keyed dispatcher.";
+    dispatcher = {};    # verb => {"trie": .., "reList": [..]}
+    for (index, route) in enumerate(routeList):
+        for verb in route.verb:
+            if verb not in dispatcher:
+                dispatcher[verb] = {"trie": mkTrieNode(), "reList": []};
+            entry = dispatcher[verb];
+            if route.mode == "re":
+                entry["reList"].append((index, route));
+            else:
+                insertTrieRoute(entry["trie"], route, index);
+    for entry in dispatcher.values():
+        entry["reGroupList"] = buildReGroupList(entry["reList"]);
+    return dispatcher;
+
+def dispatchRoute (dispatcher, routeList, verb, aPath, req):
+    "Returns first matching route from `dispatcher`, else None.";
+    entry = dispatcher.get(verb);
+    if entry is None:
+        return None;
+    # otherwise ...
+    best = [INF_INDEX, None];
+    searchTrie(entry["trie"], aPath.split("/"), 0, [], best);
+    for group in entry["reGroupList"]:
+        if group["firstIndex"] >= best[0]:
+            break;      # Earlier trie match wins.
+        if group["rex"] is None:
+            (index, route) = group["only"];
+        else:
+            m = group["rex"].match(aPath);
+            if not m:
+                continue;
+            (index, route) = group["groupMap"][m.lastindex];
+            if index >= best[0]:
+                break;
+        # Re-match, for the winning route's own match object:
+        if checkReMatch(route._rex, aPath, req, route.opt.fullMatch):
+            return route;
+    if best[0] == INF_INDEX:
+        return None;
+    # otherwise ...
+    route = routeList[best[0]];
+    if route.mode == "wildcard":
+        req.wildcards = best[1];
+    return route;
+
+def getAllowedVerbs (dispatcher, routeList, aPath):
+    "Returns sorted verbs with a route matching `aPath`, plus implied ones.";
+    # Implied: HEAD (served by GET routes) and OPTIONS (automatic).
+    scratchReq = dotsi.fy({});  # Absorbs wildcards/matched.
+    verbSet = {
+        verb for verb in dispatcher
+        if dispatchRoute(dispatcher, routeList, verb, aPath, scratchReq)
+    };
+    if not verbSet:
+        return [];
+    if "GET" in verbSet:
+        verbSet.add("HEAD");
+    verbSet.add("OPTIONS");
+    return sorted(verbSet);
+
+############################################################
+# Response Cache: ##########################################
+############################################################
+
+RESPONSE_CACHE_MAX_ENTRIES = 1024;
+RESPONSE_CACHE_MAX_BYTES = 64 * MB;
+RESPONSE_CACHE_WAIT_TIMEOUT = 10;   # Secs, for single-flight waiters.
+
+def normalizeCacheOpt (cacheOpt):
+    "Normalizes route option `cache` into a dict, else None.";
+    # `cache` may be a TTL (in seconds), or a dict like:
+    #   {"ttl": 60, "query": ["page"], "vary": ["Accept-Language"]}
+    # where `query` lists the query params to key on (default:
+    # the entire query string), and `vary` lists request headers.
+    if not cacheOpt:
+        return None;
+    if isinstance(cacheOpt, (int, float)):
+        cacheOpt = {"ttl": cacheOpt};
+    cacheOpt = dict(cacheOpt);
+    dictDefaults(cacheOpt, {"ttl": 60, "query": None, "vary": []});
+    return cacheOpt;
+
+def mkResponseCacheKey (req, cacheOpt):
+    "Makes cache key for `req` as per (normalized) `cacheOpt`.";
+    if cacheOpt["query"] is None:
+        queryPart = req.getEnviron().get("QUERY_STRING", "");
+    else:
+        queryPart = tuple(req.qdata.get(k) for k in cacheOpt["query"]);
+    varyPart = tuple(req.getHeader(name) for name in cacheOpt["vary"]);
+    verb = req.getVerb();
+    verb = "GET" if verb == "HEAD" else verb;   # HEAD replays GET's headers.
+    return (verb, req.getPathInfo(), queryPart, varyPart);
+
+def checkCacheable (res, handlerOut):
+    "True if `handlerOut` (with `res`) may be cached, as is.";
+    # Only complete 200 GET responses without cookies or deferred tasks.
+    # (HEAD handlers may skip the body, so they aren't stored.)
+    return (res.statusLine[:3] == "200" and
+        res.request.getVerb() == "GET" and
+        type(handlerOut) is not FileBody and not isStreamBody(handlerOut) and
+        not inspect.isawaitable(handlerOut) and
+        (res._cookieJar is _UNSET or not res._cookieJar) and
+        res._deferList is None
+    );
+
+def replayCacheEntry (entry, req, res):
+    "Restores cached handler output from `entry` onto `res`; returns body.";
+    for (name, value) in entry[2]:
+        if name == "CONTENT-TYPE":
+            res.contentType = value;
+        else:
+            res._headerMap[name] = value;
+    ifNoneMatch = req.getHeader("If-None-Match");
+    if ifNoneMatch is not None and checkEntryNotModified(entry, ifNoneMatch):
+        res.statusLine = "304 Not Modified";
+        return b"";
+    return entry[3];
+
+def checkEntryNotModified (entry, ifNoneMatch):
+    "True if cached `entry` has an ETag matching `ifNoneMatch`.";
+    for (name, value) in entry[2]:
+        if name == "ETAG":
+            return checkEtagMatch(ifNoneMatch, value);
+    return False;
+
+def buildResponseCache (maxEntries=RESPONSE_CACHE_MAX_ENTRIES, maxBytes=RESPONSE_CACHE_MAX_BYTES):
+    "Builds an in-process, TTL'd, LRU-evicted response cache.";
+    cache = dotsi.fy({});
+    # NB: Method names mustn't shadow `dict` methods (eg. get, clear),
+    #     else dot-access would return the latter.
+    entryMap = collections.OrderedDict();   # key => entry tuple
+    # ^ entry: (expiresAt, statusLine, headerList, bBody, routeName)
+    inflightMap = {};                       # key => threading.Event
+    lock = threading.Lock();
+    counts = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0};
+    sizeBox = [0];  # Total cached body bytes.
+    
+    def dropKey (key):
+        # Call with `lock` held.
+        entry = entryMap.pop(key, None);
+        if entry:
+            sizeBox[0] -= len(entry[3]);
+        return entry;
+    
+    def fetch (key):
+        "Returns fresh entry for `key`, else None.";
+        with lock:
+            entry = entryMap.get(key);
+            if entry and entry[0] <= time.monotonic():
+                dropKey(key);
+                counts["expirations"] += 1;
+                entry = None;
+            if entry is None:
+                counts["misses"] += 1;
+                return None;
+            entryMap.move_to_end(key);
+            counts["hits"] += 1;
+            return entry;
+    cache.fetch = fetch;
+    
+    def store (key, ttl, statusLine, headerList, bBody, routeName=None):
+        "Stores a finished response against `key`, for `ttl` secs.";
+        if len(bBody) > maxBytes:
+            return None;
+        entry = (time.monotonic() + ttl, statusLine, tuple(headerList), bBody, routeName);
+        with lock:
+            dropKey(key);
+            entryMap[key] = entry;
+            sizeBox[0] += len(bBody);
+            while len(entryMap) > maxEntries or sizeBox[0] > maxBytes:
+                dropKey(next(iter(entryMap)));
+                counts["evictions"] += 1;
+        return None;
+    cache.store = store;
+    
+    def lead (key):
+        "True if caller should compute `key`, else waits for the leader.";
+        # Single-flight: Concurrent misses for the same key wait
+        # for the first (i.e. leading) one, which must `release(.)`.
+        with lock:
+            event = inflightMap.get(key);
+            if event is None:
+                inflightMap[key] = threading.Event();
+                return True;
+        event.wait(RESPONSE_CACHE_WAIT_TIMEOUT);
+        return False;
+    cache.lead = lead;
+    
+    def release (key):
+        "Releases single-flight waiters for `key`.";
+        with lock:
+            event = inflightMap.pop(key, None);
+        if event:
+            event.set();
+    cache.release = release;
+    
+    def invalidate (key):
+        "Drops entry for `key`, if any.";
+        with lock:
+            return dropKey(key) is not None;
+    cache.invalidate = invalidate;
+    
+    def invalidateWhere (fn):
+        "Drops entries for which `fn(key, routeName)` is truthy.";
+        with lock:
+            keyList = [k for (k, e) in entryMap.items() if fn(k, e[4])];
+            for key in keyList:
+                dropKey(key);
+        return len(keyList);
+    cache.invalidateWhere = invalidateWhere;
+    cache.invalidateRoute = lambda name: invalidateWhere(lambda k, rn: rn == name);
+    cache.invalidatePath = lambda path: invalidateWhere(lambda k, rn: k[1] == path);
+    
+    def invalidateAll ():
+        "Drops all entries.";
+        with lock:
+            entryMap.clear();
+            sizeBox[0] = 0;
+    cache.invalidateAll = invalidateAll;
+    
+    def getStats ():
+        "Returns hit/miss/eviction/expiration counts, and sizes.";
+        with lock:
+            return dict(counts, entries=len(entryMap), bytes=sizeBox[0]);
+    cache.getStats = getStats;
+    
+    return cache;
+
+############################################################
+# ASGI Helpers: ############################################
+############################################################
+
+ASGI_THREADS = 32;      # Default, see app.setAsgiThreads(.)
+
+def checkAsyncHandler (fn):
+    "True if `fn` is an `async def` (incl. async generator) handler.";
+    return inspect.iscoroutinefunction(fn) or inspect.isasyncgenfunction(fn);
+
+def mkAsgiEnviron (scope, inputFile):
+    "Makes a WSGI-style environ from ASGI `scope`.";
+    # Like WSGI, str values are latin1-decoded (see latin1_to_utf8).
+    toLatin1 = lambda s: s.encode("utf8").decode("latin1");
+    server = scope.get("server") or ("localhost", 80);
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": toLatin1(scope.get("root_path", "")),
+        "PATH_INFO": toLatin1(scope["path"]),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1] or ""),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": inputFile,
+        "asgi.scope": scope,
+    };
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = str(scope["client"][0]);
+    for (bName, bValue) in scope.get("headers", []):
+        key = bName.decode("latin1").upper().replace("-", "_");
+        if key not in ["CONTENT_TYPE", "CONTENT_LENGTH"]:
+            key = "HTTP_" + key;
+        value = bValue.decode("latin1");
+        if key in environ:
+            sep = "; " if key == "HTTP_COOKIE" else ",";
+            value = environ[key] + sep + value;
+        environ[key] = value;
+    return environ;
+
+class AsgiInput (object):
+    "Blocking, file-like reader over ASGI `receive`, for worker threads.";
+    # Sync handlers run in worker threads, from which `read(.)`
+    # schedules `receive()` on the event loop, and waits for it.
+    __slots__ = ("_receive", "_loop", "_buffer", "_done");
+    
+    def __init__ (self, receive, loop):
+        self._receive = receive;
+        self._loop = loop;
+        self._buffer = bytearray();
+        self._done = False;
+    
+    def _pull (self):
+        future = asyncio.run_coroutine_threadsafe(self._receive(), self._loop);
+        message = future.result();
+        if message["type"] == "http.request":
+            self._buffer += message.get("body", b"");
+            self._done = not message.get("more_body", False);
+        else:
+            self._done = True;  # Eg. 'http.disconnect'
+    
+    def read (self, size=-1):
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            self._pull();
+        if size < 0:
+            size = len(self._buffer);
+        data = bytes(self._buffer[ : size]);
+        del self._buffer[ : size];
+        return data;
+
+async def readAsgiBody (receive, maxSize, spoolSize):
+    "Reads entire request body from `receive`, into a spooled file.";
+    f = tempfile.SpooledTemporaryFile(max_size=spoolSize);
+    size = 0;
+    while True:
+        message = await receive();
+        if message["type"] != "http.request":
+            break;
+        chunk = message.get("body", b"");
+        size += len(chunk);
+        if size > maxSize:
+            f.close();
+            raise HttpError("<h2>Request Too Large</h2>", 413, "request_too_large");
+        f.write(chunk);
+        if not message.get("more_body", False):
+            break;
+    f.seek(0);
+    return f;
+
+async def sendAsgiResponse (send, started, body, loop, executor):
+    "Sends `started` status/headers, then WSGI-style `body`, via `send`.";
+    # `body` is closed even if sending fails (eg. client disconnects).
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": int(started["statusLine"][:3]),
+            "headers": [
+                (name.lower().encode("latin1"), value.encode("latin1"))
+                for (name, value) in started["headerList"]
+            ],
+        });
+        if type(body) is list:
+            await send({"type": "http.response.body", "body": b"".join(body)});
+            return None;
+        # otherwise ...
+        if isinstance(body, ResponseStream) and body.isAsync():
+            async for chunk in body.aiterBytes():
+                await send({"type": "http.response.body", "body": chunk, "more_body": True});
+        else:
+            iterator = iter(body);
+            while True:
+                chunk = await loop.run_in_executor(executor, next, iterator, None);
+                if chunk is None:
+                    break;
+                await send({"type": "http.response.body", "body": chunk, "more_body": True});
+        await send({"type": "http.response.body", "body": b""});
+    finally:
+        if isinstance(body, ResponseStream) and body.isAsync():
+            await body.aclose();
+        elif hasattr(body, "close"):
+            await loop.run_in_executor(executor, body.close);
+    return None;
+
+async def runAsgiLifespan (receive, send, asgiState):
+    "Handles ASGI lifespan events.";
+    while True:
+        message = await receive();
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"});
+        elif message["type"] == "lifespan.shutdown":
+            if asgiState["executor"] is not None:
+                asgiState["executor"].shutdown(wait=False);
+                asgiState["executor"] = None;
+            await send({"type": "lifespan.shutdown.complete"});
+            return None;
+
+############################################################
+# Instrumentation: #########################################
+############################################################
+
+perfClock = time.perf_counter;  # Monotonic, high-resolution.
+
+# Stages, each paired with the stamp marking its end:
+STAGE_END_LIST = [
+    ("build", "built"),     # buildRequest(.) etc., until route matching.
+    ("match", "matched"),   # Route matching.
+    ("plugins", "plugged"), # Route settings & plugin application.
+    ("handler", "handled"), # Handler (or error handler).
+    ("finish", "finished"), # res._finish(.), excl. streamed iteration.
+];
+
+def mkTiming (verb, path):
+    "Makes a per-request timing dict, passed to observers when done.";
+    return {
+        "verb": verb, "path": path, "route": None,
+        "status": None, "bodySize": None, "stamps": {"start": perfClock()},
+    };
+
+def timingToStages (stamps):
+    "Returns {stage: secs}, for stages whose end was stamped.";
+    stageMap = {};
+    prev = stamps["start"];
+    for (stage, end) in STAGE_END_LIST:
+        if end in stamps:
+            stageMap[stage] = stamps[end] - prev;
+            prev = stamps[end];
+    stageMap["total"] = prev - stamps["start"];
+    return stageMap;
+
+def fmtServerTiming (stageMap):
+    "Formats `stageMap` (secs) as a `Server-Timing` header value (ms).";
+    return ", ".join(
+        "%s;dur=%.3f" % (stage, secs * 1000) for (stage, secs) in stageMap.items()
+    );
+
+HISTOGRAM_BUCKET_LIST = [   # Upper bounds, in ms.
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000,
+];
+
+def buildStageHistogram (bucketList=HISTOGRAM_BUCKET_LIST):
+    "Builds a per-route, per-stage latency histogram (an observer).";
+    hist = dotsi.fy({});
+    # NB: Method names mustn't shadow `dict` methods (eg. clear).
+    dataMap = {};   # (route, stage) => [count, sumMs, maxMs, bucketCounts]
+    lock = threading.Lock();
+    
+    def observe (timing):
+        "Observer, pass to app.addObserver(.)";
+        route = timing["route"] or "(unmatched)";
+        stageMap = timingToStages(timing["stamps"]);
+        with lock:
+            for (stage, secs) in stageMap.items():
+                ms = secs * 1000;
+                data = dataMap.get((route, stage));
+                if data is None:
+                    data = dataMap[(route, stage)] = [0, 0.0, 0.0, [0] * (len(bucketList) + 1)];
+                data[0] += 1;
+                data[1] += ms;
+                data[2] = max(data[2], ms);
+                data[3][bisect.bisect_left(bucketList, ms)] += 1;
+    hist.observe = observe;
+    
+    def estimatePercentile (data, fraction):
+        # Upper bound of the bucket containing the percentile:
+        target, seen = data[0] * fraction, 0;
+        for (i, n) in enumerate(data[3]):
+            seen += n;
+            if seen >= target:
+                return bucketList[i] if i < len(bucketList) else data[2];
+        return data[2];
+    
+    def getDict ():
+        "Returns {route: {stage: {count, avgMs, maxMs, p50Ms, p99Ms, buckets}}}.";
+        out = {};
+        with lock:
+            for ((route, stage), data) in dataMap.items():
+                out.setdefault(route, {})[stage] = {
+                    "count": data[0], "avgMs": data[1] / data[0], "maxMs": data[2],
+                    "p50Ms": estimatePercentile(data, 0.50),
+                    "p99Ms": estimatePercentile(data, 0.99),
+                    "buckets": dict(zip(bucketList + ["inf"], data[3])),
+                };
+        return out;
+    hist.getDict = getDict;
+    
+    def dumpText ():
+        "Returns a plain-text table of getDict()'s summary.";
+        lineList = ["%-30s %-8s %8s %9s %9s %9s %9s" % (
+            "route", "stage", "count", "avg(ms)", "p50(ms)", "p99(ms)", "max(ms)",
+        )];
+        for (route, stageMap) in sorted(getDict().items()):
+            for (stage, st) in stageMap.items():
+                lineList.append("%-30s %-8s %8d %9.3f %9.3f %9.3f %9.3f" % (
+                    route, stage, st["count"], st["avgMs"],
+                    st["p50Ms"], st["p99Ms"], st["maxMs"],
+                ));
+        return "\n".join(lineList);
+    hist.dumpText = dumpText;
+    
+    def reset ():
+        "Discards all collected data.";
+        with lock:
+            dataMap.clear();
+    hist.reset = reset;
+    
+    return hist;
 
 ############################################################
 # App: #####################################################
@@ -536,33 +2558,52 @@ def buildApp ():
     app = dotsi.fy({});
     app.routeList = [];
     app.pluginList = [];
+    cache = {           # Plain dict, not dotsi-fied.
+        "dispatcher": None,     # Compiled routes, see resetRouteCache().
+        "routeNameMap": None,   # name => route, built lazily.
+        "pluggedErrorMap": {},  # fwCode => (efn, pefn), if plugging errors.
+    };
     
     # Route Adding: ::::::::::::::::::::::::::::::::::::::::
     
+    def getRouteNameMap ():
+        if cache["routeNameMap"] is None:
+            cache["routeNameMap"] = {rt.name: rt for rt in app.routeList if rt.name};
+        return cache["routeNameMap"];
+    
     def findNamedRoute (name):
         "Returns route named `name`, else None.";
         if name is None: return None;
-        rtList = filterli(app.routeList, lambda rt: rt.name == name);
-        assert len(rtList) <= 1;
-        return rtList[0] if rtList else None;
+        return getRouteNameMap().get(name);
     app.findNamedRoute = findNamedRoute;
     
-    def addRoute (verb, path, fn, mode=None, name=None, top=False):
+    def resetRouteCache ():
+        "Discards compiled routing data, rebuilt lazily.";
+        # Call after modifying `app.routeList` directly.
+        cache["dispatcher"] = None;
+        cache["routeNameMap"] = None;
+    app.resetRouteCache = resetRouteCache;
+    
+    def addRoute (verb, path, fn, mode=None, name=None, top=False, **opt):
         "Add a route handler `fn` against `path`, for `verb`.";
         assert type(top) is bool;
         if findNamedRoute(name):
             raise ValueError("Route with name %r already exists." % name);
         index = 0 if top else len(app.routeList);
-        route = buildRoute(verb, path, fn, mode, name);
+        route = buildRoute(verb, path, fn, mode, name, **opt);
         app.routeList.insert(index, route);
+        if name:
+            getRouteNameMap()[name] = route;
+        cache["dispatcher"] = None;
     app.addRoute = addRoute;
             
-    def mkRouteDeco (verb, path, mode=None, name=None, top=False):
+    def mkRouteDeco (verb, path, mode=None, name=None, top=False, **opt):
         "Makes a decorator for adding routes.";
         # TODO: Write documentation for param `top`.
         # TODO: Consider (DON'T!) making 'GET' the default verb.
+        # Route options (`opt`) are listed in `routeOptDefaults`.
         def identityDecorator (fn):
-            addRoute(verb, path, fn, mode, name, top);
+            addRoute(verb, path, fn, mode, name, top, **opt);
             return fn;
         return identityDecorator;
     app.route = mkRouteDeco;
@@ -575,18 +2616,133 @@ def buildApp ():
             raise ValueError("No such route with name %r." % name);
         # otherwise ...
         app.routeList.remove(rt);
+        rt._pfn = None;     # Popped route, drop plugged fn.
+        del getRouteNameMap()[name];
+        cache["dispatcher"] = None;
         return rt;
     app.popNamedRoute = popNamedRoute;
     
+    def urlFor (name, *wildcards, **query):
+        "Builds URL for route named `name`, filling wildcards/groups.";
+        rt = findNamedRoute(name);
+        if not rt:
+            raise ValueError("No such route with name %r." % name);
+        # otherwise ...
+        if rt._urlTemplate is None:
+            rt._urlTemplate = mkUrlTemplate(rt);
+        fmt, safeList = rt._urlTemplate;
+        if len(wildcards) != len(safeList):
+            raise ValueError("Route %r expects %d wildcard(s), got %d." % (
+                name, len(safeList), len(wildcards),
+            ));
+        url = fmt % tuple(
+            urllib.parse.quote(str(w), safe=safe) for (w, safe) in zip(wildcards, safeList)
+        );
+        if query:
+            url += "?" + urllib.parse.urlencode(query, doseq=True);
+        return url;
+    app.urlFor = urlFor;
+    
+    # Static Mounts: :::::::::::::::::::::::::::::::::::::::
+    
+    def mountStatic (urlPrefix, directory, autoRefresh=False, memCacheSize=0,
+            maxMemFileSize=64 * KB, includeHidden=False, name=None):
+        "Serves files in `directory` under `urlPrefix`, via a manifest.";
+        # Files are looked up in an in-memory manifest (built now),
+        # so unlisted paths (incl. '../' traversals) are never touched.
+        # With `autoRefresh`, each hit re-stats its file (re-scanning
+        # its variants if changed), and misses trigger a rescan (at
+        # most once per second), to pick up new files.
+        # With `memCacheSize`, upto that many small files (each upto
+        # `maxMemFileSize` bytes) are cached in memory, LRU-evicted.
+        directory = os.path.abspath(directory);
+        mount = {
+            "manifest": buildStaticManifest(directory, includeHidden),
+            "scannedAt": time.monotonic(),
+        };
+        memCache = collections.OrderedDict();   # path => (mtime_ns, data)
+        memLock = threading.Lock();
+        
+        def refreshEntry (relpath, entry):
+            try:
+                st = os.stat(entry["path"]);
+            except OSError:
+                st = None;
+            if st and (st.st_mtime_ns, st.st_size) == (entry["mtime_ns"], entry["size"]):
+                return entry;
+            # otherwise ...
+            newEntry = scanStaticFile(entry["path"]);
+            newEntry = addStaticVariants(newEntry) if newEntry else None;
+            if newEntry:
+                mount["manifest"][relpath] = newEntry;
+            else:
+                mount["manifest"].pop(relpath, None);
+            return newEntry;
+        
+        def lookup (relpath):
+            entry = mount["manifest"].get(relpath);
+            if not autoRefresh:
+                return entry;
+            if entry:
+                return refreshEntry(relpath, entry);
+            if time.monotonic() - mount["scannedAt"] >= 1:
+                mount["manifest"] = buildStaticManifest(directory, includeHidden);
+                mount["scannedAt"] = time.monotonic();
+                return mount["manifest"].get(relpath);
+            return None;
+        
+        def readCached (entry):
+            if not memCacheSize or entry["size"] > maxMemFileSize:
+                return None;
+            key = entry["path"];
+            with memLock:
+                cached = memCache.get(key);
+                if cached and cached[0] == entry["mtime_ns"]:
+                    memCache.move_to_end(key);
+                    return cached[1];
+            try:
+                with open(key, "rb") as f:
+                    data = f.read();
+            except OSError:
+                return None;
+            with memLock:
+                memCache[key] = (entry["mtime_ns"], data);
+                while len(memCache) > memCacheSize:
+                    memCache.popitem(last=False);
+            return data;
+        
+        def serveStatic (req, res):
+            entry = lookup(req.wildcards[0]);
+            if not entry:
+                raise HttpError("<h2>File Not Found<h2>", 404, "file_not_found");
+            mimeType = entry["mimeType"];
+            if entry["variants"]:
+                res.setHeader("Vary", "Accept-Encoding");
+                qMap = parseAcceptEncoding(req.getHeader("Accept-Encoding"));
+                for (coding, ext) in staticVariantList:
+                    variant = entry["variants"].get(coding);
+                    if variant and checkAcceptsEncoding(qMap, coding):
+                        res.setHeader("Content-Encoding", coding);
+                        entry = variant;
+                        break;
+            return res._serveFile(
+                entry["path"], entry["size"], entry["mtime"], entry["etag"],
+                entry["lastModified"], mimeType, readCached(entry),
+            );
+        
+        addRoute("GET", urlPrefix.rstrip("/") + "/**", serveStatic, "wildcard", name);
+    app.mountStatic = mountStatic;
+    
     # Plugins: :::::::::::::::::::::::::::::::::::::::::::::
     
     def install (plugin):
         "Installs `plugin`.";
         app.pluginList.append(plugin);
+        resetPluginCache();
     app.install = install;
     
-    def plugRoute (matchedRoute):
-        pfn = matchedRoute.fn;  # pfn: Plugged fn.
+    def applyPlugins (fn):
+        pfn = fn;  # pfn: Plugged fn.
         for plugin in reversed(app.pluginList):
             # See note regarding `reversed(.)` below.
             pfn = plugin(pfn);  # Apply each plugin.
@@ -598,6 +2754,298 @@ def buildApp ():
         #   The latter feels more natural.
         #   i.e., plugins installed 1st are applied 1st.
     
+    def plugRoute (matchedRoute):
+        "Returns plugged fn for `matchedRoute`, cached on the route.";
+        if matchedRoute._pfn is None:
+            fn = matchedRoute.fn;
+            if matchedRoute._cacheOpt:
+                fn = mkCachingFn(matchedRoute);   # Innermost, see below.
+            matchedRoute._pfn = applyPlugins(fn);
+        return matchedRoute._pfn;
+    app.plugRoute = plugRoute;
+    
+    def plugErrorHandler (fwCode, efn):
+        "Returns plugged `efn` (for `fwCode`), cached.";
+        cached = cache["pluggedErrorMap"].get(fwCode);
+        if cached and cached[0] is efn:
+            return cached[1];
+        # otherwise ...
+        pefn = applyPlugins(efn);
+        cache["pluggedErrorMap"][fwCode] = (efn, pefn);
+        return pefn;
+    
+    def resetPluginCache ():
+        "Discards cached plugged fns, re-plugged lazily.";
+        for rt in app.routeList:
+            rt._pfn = None;
+        autoOptionsRoute._pfn = None;   # Not in app.routeList.
+        cache["pluggedErrorMap"] = {};
+    app.resetPluginCache = resetPluginCache;
+    
+    # Request Body Limits: :::::::::::::::::::::::::::::::::
+    
+    app.maxBodySize = MAX_REQUEST_BODY_SIZE;
+    app.bodySpoolSize = BODY_SPOOL_SIZE;
+    app.maxPartSize = None;     # Per multipart part, None => No extra limit.
+    def setBodyLimits (maxSize, spoolSize=None, maxPartSize=None):
+        "Sets max request body size, and (optionally) spool & part size.";
+        app.maxBodySize = int(maxSize);
+        if spoolSize is not None:
+            app.bodySpoolSize = int(spoolSize);
+        if maxPartSize is not None:
+            app.maxPartSize = int(maxPartSize);
+    app.setBodyLimits = setBodyLimits;
+    
+    # Compression: :::::::::::::::::::::::::::::::::::::::::
+    
+    app.compression = None;     # None => Disabled (by default).
+    def setCompression (enabled=True, level=COMPRESSION_LEVEL, minSize=COMPRESSION_MIN_SIZE):
+        "Enable/disable response compression (gzip/deflate), app-wide.";
+        app.compression = {"level": level, "minSize": minSize} if enabled else None;
+    app.setCompression = setCompression;
+    
+    def getRouteCompression (route):
+        "Returns compression settings for `route`, else None.";
+        if route.opt.compress is None:
+            return app.compression;
+        if not route.opt.compress:
+            return None;
+        return app.compression or dotsi.fy({
+            "level": COMPRESSION_LEVEL, "minSize": COMPRESSION_MIN_SIZE,
+        });
+    
+    # Automatic ETags: :::::::::::::::::::::::::::::::::::::
+    
+    app.etagMode = None;        # None => Disabled (by default).
+    def setAutoEtag (mode="weak"):
+        "Enable ('weak' or 'strong') or disable (None) body-hash ETags, app-wide.";
+        app.etagMode = normalizeEtagMode(mode);
+    app.setAutoEtag = setAutoEtag;
+    
+    def getRouteEtagMode (route):
+        "Returns ETag mode for `route`, else None.";
+        if route.opt.etag is None:
+            return app.etagMode;
+        return normalizeEtagMode(route.opt.etag);
+    
+    # JSON Codec: ::::::::::::::::::::::::::::::::::::::::::
+    
+    app.jsonCodec = stdJsonCodec;
+    def setJsonCodec (codec=None, default=None):
+        "Sets JSON codec (see buildJsonCodec), or just a `default` fn.";
+        app.jsonCodec = codec or buildJsonCodec(default=default);
+    app.setJsonCodec = setJsonCodec;
+    
+    # Response Cache: ::::::::::::::::::::::::::::::::::::::
+    
+    app.responseCache = buildResponseCache();
+    # ^ Replace with buildResponseCache(maxEntries, maxBytes) for custom limits.
+    
+    def mkCachingFn (route):
+        "Wraps `route.fn`, to serve its output via app.responseCache.";
+        # Wrapped *before* plugins are applied, so plugins (eg. auth)
+        # run on every request, cache hits included. Only the handler's
+        # own work is cached: its body bytes, content type & headers.
+        # Finishing (compression, ETags etc.) happens per request.
+        fn, cacheOpt = route.fn, route._cacheOpt;
+        def cachingFn (req, res, *args, **kwargs):
+            if req.getVerb() not in ["GET", "HEAD"]:
+                return fn(req, res, *args, **kwargs);
+            # otherwise ...
+            rcache = app.responseCache;
+            key = mkResponseCacheKey(req, cacheOpt);
+            entry = rcache.fetch(key);
+            isLeader = False;
+            if entry is None:
+                isLeader = rcache.lead(key);
+                entry = None if isLeader else rcache.fetch(key);
+            if entry is not None:
+                return replayCacheEntry(entry, req, res);
+            # otherwise ...
+            try:
+                headerSnapshot = dict(res._headerMap);  # Eg. set by plugins.
+                handlerOut = fn(req, res, *args, **kwargs);
+                if checkSessionModified(req) or not checkCacheable(res, handlerOut):
+                    return handlerOut;  # Session changes mustn't be replayed.
+                # otherwise ...
+                bBody = res._bytify(handlerOut);    # Sets contentType, for JSON.
+                headerList = [
+                    (name, value) for (name, value) in res._headerMap.items()
+                    if headerSnapshot.get(name) != value
+                ];
+                headerList.append(("CONTENT-TYPE", res.contentType));
+                rcache.store(key, cacheOpt["ttl"], res.statusLine,
+                    headerList, bBody, route.name,
+                );
+                return bBody;
+            finally:
+                if isLeader:
+                    rcache.release(key);
+        return cachingFn;
+    
+    # Deferred Tasks: ::::::::::::::::::::::::::::::::::::::
+    
+    app.deferPool = buildTaskPool();    # Threads start on first use.
+    def setDeferPool (threads=DEFER_THREADS, maxQueue=DEFER_MAX_QUEUE, overflow="drop", onError=None):
+        "Configures the pool that runs tasks scheduled via `res.defer(.)`";
+        app.deferPool = buildTaskPool(threads, maxQueue, overflow, onError);
+    app.setDeferPool = setDeferPool;
+    
+    # Admission Control: :::::::::::::::::::::::::::::::::::
+    
+    admission = {       # Plain dict, not dotsi-fied.
+        "limiter": None,        # App-wide, see setConcurrencyLimit(.)
+        "queueTimeout": 0,      # Max secs to wait for a slot.
+        "rateLimiter": None,    # Per-client, see setRateLimit(.)
+        "keyFn": getClientAddr,
+    };
+    
+    def setConcurrencyLimit (maxInFlight, queueTimeout=0, maxQueue=None):
+        "Caps in-flight requests app-wide; pass None to remove the cap.";
+        # `queueTimeout` also applies to per-route `maxInFlight` caps.
+        admission["limiter"] = buildLimiter(maxInFlight, maxQueue) if maxInFlight else None;
+        admission["queueTimeout"] = queueTimeout;
+    app.setConcurrencyLimit = setConcurrencyLimit;
+    
+    def setRateLimit (rate, burst=None, keyFn=None, maxClients=RATE_LIMIT_MAX_CLIENTS):
+        "Limits each client (per `keyFn(req)`) to `rate` requests/sec.";
+        admission["rateLimiter"] = buildRateLimiter(rate, burst, maxClients) if rate else None;
+        admission["keyFn"] = keyFn or getClientAddr;
+    app.setRateLimit = setRateLimit;
+    
+    def getAdmissionStats ():
+        "Returns admission counters, for monitoring.";
+        limiter, rateLimiter = admission["limiter"], admission["rateLimiter"];
+        return {
+            "app": limiter.getStats() if limiter else None,
+            "rate": rateLimiter.getStats() if rateLimiter else None,
+            "routes": {
+                (rt.name or rt.path): rt._limiter.getStats()
+                for rt in app.routeList if rt._limiter
+            },
+        };
+    app.getAdmissionStats = getAdmissionStats;
+    
+    def checkRateLimit (req, res):
+        "Raises HttpError (429) if `req`'s client is over the rate limit.";
+        # Before routing, so that floods of 404s are limited too.
+        wait = admission["rateLimiter"].check(admission["keyFn"](req));
+        if wait:
+            res.setHeader("Retry-After", str(math.ceil(wait)));
+            raise HttpError("<h2>Too Many Requests</h2>", 429, "rate_limited");
+    
+    def admitRequest (mRoute, req, res, queueTimeout):
+        "Admits `req` to `mRoute`, else raises HttpError (503).";
+        deadline = perfClock() + queueTimeout;
+        for limiter in [admission["limiter"], mRoute._limiter]:
+            if limiter is None:
+                continue;
+            if not limiter.acquire(deadline - perfClock()):
+                res.setHeader("Retry-After", "1");
+                raise HttpError("<h2>Service Unavailable</h2>", 503, "service_overloaded");
+            if res._releaseList is None:
+                res._releaseList = [];
+            res._releaseList.append(limiter.release);
+    
+    def checkAdmissionNeeded (mRoute):
+        return bool(admission["limiter"] or mRoute._limiter);
+    
+    def finishHeld (res, handlerOut):
+        "Like `res._finish(.)`, but releases held limiters if it fails.";
+        try:
+            return res._finish(handlerOut);
+        except BaseException:
+            if res._releaseList is not None:
+                res._wrapReleases([]);  # Releases now, else slots leak.
+            raise;
+    
+    def wrapBody (res, body):
+        "Wraps `body` to release held limiters & run deferred tasks.";
+        if res._releaseList is not None:
+            body = res._wrapReleases(body);
+        if res._deferList is not None:
+            body = res._wrapDeferred(body);
+        return body;
+    
+    # Sessions: ::::::::::::::::::::::::::::::::::::::::::::
+    
+    app.sessionConfig = None;
+    def setSessions (store, secret, cookieName=SESSION_COOKIE_NAME, ttl=SESSION_TTL, cookieOpt=None):
+        "Enables `req.session`, kept in `store`, keyed by a signed cookie.";
+        app.sessionConfig = dotsi.fy({
+            "store": store, "signer": toSigner(secret),
+            "cookieName": cookieName, "ttl": ttl,
+            "cookieOpt": dict({"max-age": ttl}, **(cookieOpt or {})),
+        });
+    app.setSessions = setSessions;
+    
+    def saveSession (req, res):
+        "Writes back `req.session`, as it's been modified.";
+        session, config = req._session, app.sessionConfig;
+        if session._invalidate:
+            if session.sid is not None:
+                config.store.delete(session.sid);
+                res.setUnsignedCookie(config.cookieName, "",
+                    dict(config.cookieOpt, **{"max-age": 0}),
+                );
+            return;
+        if session.sid is None and not session:
+            return;     # New & empty, nothing to save.
+        if session._regenerate and session.sid is not None:
+            config.store.delete(session.sid);
+        if session.sid is None or session._regenerate:
+            session.sid = mkSessionId();
+            res.setCookie(config.cookieName, session.sid, config.signer,
+                dict(config.cookieOpt),
+            );
+        config.store.save(session.sid, dict(session), config.ttl);
+        session.modified = session._regenerate = False;
+    
+    def checkSessionModified (req):
+        return req._session is not _UNSET and req._session.modified;
+    
+    # Instrumentation: :::::::::::::::::::::::::::::::::::::
+    
+    app.observerList = ();      # Tuple, for lock-free iteration.
+    def addObserver (fn):
+        "Registers `fn(timing)`, called after each request.";
+        app.observerList = app.observerList + (fn,);
+    app.addObserver = addObserver;
+    
+    def removeObserver (fn):
+        "Unregisters observer `fn`.";
+        app.observerList = tuple(f for f in app.observerList if f != fn);
+    app.removeObserver = removeObserver;
+    
+    app.serverTiming = False;
+    def setServerTiming (enabled=True):
+        "Enable/disable the `Server-Timing` response header.";
+        app.serverTiming = bool(enabled);
+    app.setServerTiming = setServerTiming;
+    
+    def checkTimingNeeded ():
+        return bool(app.observerList or app.serverTiming);
+    
+    def endTiming (timing, res, body):
+        "Completes `timing`, and notifies observers.";
+        timing["stamps"]["finished"] = perfClock();
+        timing["status"] = int(res.statusLine[:3]);
+        if type(body) is list:
+            timing["bodySize"] = sum(map(len, body));
+        for fn in app.observerList:
+            try:
+                fn(timing);
+            except Exception as e:
+                print("\nObserver error:\n" + formatTraceback(e) + "\n");
+    
+    # Default Headers: :::::::::::::::::::::::::::::::::::::
+    
+    app.defaultHeaders = ();    # Pre-encoded (name, value) pairs.
+    def setDefaultHeaders (headers):
+        "Sets headers (dict or list) to be sent with each response.";
+        app.defaultHeaders = encodeHeaders(headers);
+    app.setDefaultHeaders = setDefaultHeaders;
+    
     # Errors: ::::::::::::::::::::::::::::::::::::::::::::::
 
     app.inDebugMode = False;
@@ -606,6 +3054,12 @@ def buildApp ():
         app.inDebugMode = bool(boolean);
     app.setDebug = setDebug;
     
+    app.inErrorPluggingMode = False;
+    def setErrorPlugging (boolean):
+        "Enable/disable applying plugins to framework-error handlers.";
+        app.inErrorPluggingMode = bool(boolean);
+    app.setErrorPlugging = setErrorPlugging;
+    
     def mkDefault_frameworkError_handler (code, msg=None):
         "Makes a default error handler for framework errors."
         statusLine = getStatusLineFromCode(code);
@@ -631,13 +3085,16 @@ def buildApp ():
             <pre style="font-size: 20px; font-weight: bold;">%s</pre>
             <pre style="font-size: 15px;">%s</pre>
         """, [
-            repr(xErr), traceback.format_exc(),
+            repr(xErr), formatTraceback(xErr),
         ]);
         
     app.frameworkErrorHandlerMap = {
         "route_not_found":  mkDefault_frameworkError_handler(404, "No such route."),
         "file_not_found":   mkDefault_frameworkError_handler(404, "No such file."),
+        "method_not_allowed": mkDefault_frameworkError_handler(405, "Method not allowed."),
         "request_too_large": mkDefault_frameworkError_handler(413, "Request too large."),
+        "rate_limited":     mkDefault_frameworkError_handler(429, "Too many requests."),
+        "service_overloaded": mkDefault_frameworkError_handler(503, "Service overloaded."),
         "unexpected_error": default_frameworkError_unexpected,
     };
     def frameworkError (_fwCode):
@@ -656,52 +3113,366 @@ def buildApp ():
         "Returns a matching route for a given request `req`.";
         reqVerb = req.getVerb();
         reqPath = req.getPathInfo();
-        
-        verbMatch = lambda rt: (
-            (type(rt.verb) is str and reqVerb == rt.verb) or
-            (type(rt.verb) is list and reqVerb in rt.verb) #or
+        if cache["dispatcher"] is None:
+            cache["dispatcher"] = buildDispatcher(app.routeList);
+        rt = dispatchRoute(
+            cache["dispatcher"], app.routeList, reqVerb, reqPath, req,
         );
-        for rt in app.routeList:
-            if reqVerb in rt.verb and checkRouteMatch(rt, req):
-                return rt;
+        if rt is not None:
+            return rt;
+        if reqVerb == "HEAD":
+            rt = dispatchRoute(
+                cache["dispatcher"], app.routeList, "GET", reqPath, req,
+            );
+            if rt is not None:
+                return rt;      # Body is dropped by `res._finish(.)`
+        # otherwise, is the path routed for other verbs? ...
+        allowList = getAllowedVerbs(cache["dispatcher"], app.routeList, reqPath);
+        if allowList:
+            if req.response is not None:
+                req.response.setHeader("Allow", ", ".join(allowList));
+            if reqVerb == "OPTIONS":
+                return autoOptionsRoute;
+            raise HttpError("<h2>Method Not Allowed</h2>", 405, "method_not_allowed");
         # otherwise ..
         raise HttpError("<h2>Route Not Found</h2>", 404, "route_not_found");
+    app.getMatchingRoute = getMatchingRoute;
     
-    def wsgi (environ, start_response):
-        "WSGI callable.";
-        #pprint.pprint(environ);
+    def handleAutoOptions (req, res):
+        "Answers OPTIONS, with the `Allow` header set by getMatchingRoute(.)";
+        res.statusLine = "204 No Content";
+        return b"";
+    autoOptionsRoute = buildRoute("OPTIONS", "*", handleAutoOptions, mode="exact");
+    
+    def warmUp ():
+        "Precompiles routing data, eg. before forking workers.";
+        getRouteNameMap();
+        if cache["dispatcher"] is None:
+            cache["dispatcher"] = buildDispatcher(app.routeList);
+    app.warmUp = warmUp;
+    
+    def prepareRequest (environ, start_response):
+        "Builds & binds `req` and `res`, with app-level settings.";
         req = buildRequest(environ);
         res = buildResponse(start_response);
         req.bindApp(app, res);
         res.bindApp(app, req);
+        req._maxBodySize = app.maxBodySize;
+        req._spoolSize = app.bodySpoolSize;
+        req._maxPartSize = app.maxPartSize;
+        res._compression = app.compression;
+        res._etagMode = app.etagMode;
+        req._jsonCodec = res._jsonCodec = app.jsonCodec;
+        return req, res;
+    
+    def applyRouteSettings (mRoute, req, res):
+        "Applies `mRoute`'s per-route settings to `req` and `res`.";
+        if mRoute.opt.maxBodySize is not None:
+            req._maxBodySize = mRoute.opt.maxBodySize;
+        if mRoute.opt.maxPartSize is not None:
+            req._maxPartSize = mRoute.opt.maxPartSize;
+        res._compression = getRouteCompression(mRoute);
+        if mRoute.opt.etag is not None:
+            res._etagMode = getRouteEtagMode(mRoute);
+        if not mRoute.opt.decodeBody:
+            req._fdata = dotsi.fy({});  # Body is left as-is, unparsed.
+        req._checkContentLength();    # Early, before reading.
+    
+    def handleError (req, res, err):
+        "Produces handler output for error `err`.";
+        if isinstance(err, HttpError):
+            res.statusLine = err.statusLine;
+            if err._fwCode not in app.frameworkErrorHandlerMap:
+                return err.body;
+            # otherwise ...
+            efn = app.frameworkErrorHandlerMap[err._fwCode];
+            if app.inErrorPluggingMode:
+                efn = plugErrorHandler(err._fwCode, efn);
+            return efn(req, res, err);
+        # otherwise ...
+        print("\n" + formatTraceback(err) + "\n");
+        # ^ Use `+`, not `,` to avoid space.
+        httpErr = HttpError(
+            "<h2>Internal Server Error</h2>", 500, "unexpected_error",
+        );
+        res.statusLine = httpErr.statusLine;
+        efn = app.frameworkErrorHandlerMap[httpErr._fwCode];
+        # ^ i.e. app.frameworkErrorHandlerMap["unexpected_error"];
+        # Not plugged, as a plugin may itself have failed.
+        return efn(req, res, err);
+    
+    def runRoute (req, res, timing=None, matched=None):
+        "Matches & runs route for `req`; returns WSGI iterable.";
+        # If passed, `matched` is the route (or HttpError) already
+        # matched by asgi(.), which then also stamps `timing`.
         #print(req.bodyBytes);
         try:
-            mRoute = getMatchingRoute(req);
+            if matched is None:
+                if admission["rateLimiter"] is not None:
+                    checkRateLimit(req, res);
+                mRoute = getMatchingRoute(req);
+                if timing is not None:
+                    timing["route"] = mRoute.name or mRoute.path;
+                    timing["stamps"]["matched"] = perfClock();
+            elif isinstance(matched, HttpError):
+                raise matched;
+            else:
+                mRoute = matched;
+            if checkAdmissionNeeded(mRoute):
+                admitRequest(mRoute, req, res, admission["queueTimeout"]);
+            applyRouteSettings(mRoute, req, res);
             pfn = plugRoute(mRoute);  # p: Plugin, fn: FuNc
+            if timing is not None:
+                timing["stamps"]["plugged"] = perfClock();
             handlerOut = pfn(req, res);
+            if inspect.isawaitable(handlerOut) or hasattr(handlerOut, "__anext__"):
+                if inspect.iscoroutine(handlerOut):
+                    handlerOut.close();     # Avoid never-awaited warning.
+                raise TypeError("Async handlers require `app.asgi`.");
+            if checkSessionModified(req):
+                saveSession(req, res);
+        except Exception as e:
+            handlerOut = handleError(req, res, e);
+        if timing is not None:
+            timing["stamps"]["handled"] = perfClock();
+            if app.serverTiming:
+                res.setHeader("Server-Timing", fmtServerTiming(timingToStages(timing["stamps"])));
+        if res._releaseList is None:
+            return res._finish(handlerOut);
+        return finishHeld(res, handlerOut);
+    
+    def runTimedRoute (environ, start_response):
+        "Like wsgi(.), but with `timing`, for observers & Server-Timing.";
+        timing = mkTiming(environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"));
+        req, res = prepareRequest(environ, start_response);
+        timing["stamps"]["built"] = perfClock();
+        body = runRoute(req, res, timing);
+        endTiming(timing, res, body);
+        return wrapBody(res, body);
+    
+    def wsgi (environ, start_response):
+        "WSGI callable.";
+        #pprint.pprint(environ);
+        if checkTimingNeeded():
+            return runTimedRoute(environ, start_response);
+        # otherwise ...
+        req, res = prepareRequest(environ, start_response);
+        body = runRoute(req, res);
+        if res._deferList is None and res._releaseList is None:
+            return body;
+        return wrapBody(res, body);
+    app.wsgi = wsgi;
+    
+    # ASGI callable: :::::::::::::::::::::::::::::::::::::::
+    
+    app.asgiThreads = ASGI_THREADS;
+    asgiState = {"executor": None};
+    def setAsgiThreads (n):
+        "Sets max threads for running sync handlers under `app.asgi`.";
+        app.asgiThreads = int(n);
+        oldExecutor, asgiState["executor"] = asgiState["executor"], None;
+        if oldExecutor is not None:
+            oldExecutor.shutdown(wait=False);   # Rebuilt lazily, resized.
+    app.setAsgiThreads = setAsgiThreads;
+    
+    def getAsgiExecutor ():
+        if asgiState["executor"] is None:
+            asgiState["executor"] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=app.asgiThreads, thread_name_prefix="vilo-asgi",
+            );
+        return asgiState["executor"];
+    
+    async def runAsyncRoute (mRoute, req, res, receive, executor, timing=None):
+        "Runs async handler of `mRoute`; returns WSGI-style iterable.";
+        loop = asyncio.get_running_loop();
+        try:
+            if checkAdmissionNeeded(mRoute):
+                admitRequest(mRoute, req, res, 0);  # Don't block the loop.
+            applyRouteSettings(mRoute, req, res);
+            # Pre-buffer body, so `req` may be read without blocking:
+            req.getEnviron()["wsgi.input"] = await readAsgiBody(
+                receive, req._maxBodySize, req._spoolSize,
+            );
+            pfn = plugRoute(mRoute);
+            if timing is not None:
+                timing["stamps"]["plugged"] = perfClock();
+            handlerOut = pfn(req, res);
+            if inspect.isawaitable(handlerOut):
+                handlerOut = await handlerOut;
+            if checkSessionModified(req):
+                await loop.run_in_executor(executor, saveSession, req, res);
+        except Exception as e:
+            handlerOut = await loop.run_in_executor(executor, handleError, req, res, e);
+        if timing is not None:
+            timing["stamps"]["handled"] = perfClock();
+            if app.serverTiming:
+                res.setHeader("Server-Timing", fmtServerTiming(timingToStages(timing["stamps"])));
+        if res._releaseList is None:
+            return res._finish(handlerOut);
+        return finishHeld(res, handlerOut);
+    
+    async def asgi (scope, receive, send):
+        "ASGI callable. Async handlers run natively, sync ones in threads.";
+        if scope["type"] == "lifespan":
+            return await runAsgiLifespan(receive, send, asgiState);
+        if scope["type"] != "http":
+            raise ValueError("Unsupported ASGI scope type: %r" % scope["type"]);
+        # otherwise ...
+        loop = asyncio.get_running_loop();
+        executor = getAsgiExecutor();
+        environ = mkAsgiEnviron(scope, AsgiInput(receive, loop));
+        started = {};
+        def start_response (statusLine, headerList, *args):
+            started.update(statusLine=statusLine, headerList=headerList);
+        timing = None;
+        if checkTimingNeeded():
+            timing = mkTiming(environ["REQUEST_METHOD"], environ["PATH_INFO"]);
+        req, res = prepareRequest(environ, start_response);
+        if timing is not None:
+            timing["stamps"]["built"] = perfClock();
+        try:
+            if admission["rateLimiter"] is not None:
+                checkRateLimit(req, res);
+            matched = getMatchingRoute(req);
+            if timing is not None:
+                timing["route"] = matched.name or matched.path;
+                timing["stamps"]["matched"] = perfClock();
         except HttpError as e:
-            res.statusLine = e.statusLine;
-            if e._fwCode in app.frameworkErrorHandlerMap:
-                efn = app.frameworkErrorHandlerMap[e._fwCode];
-                #TODO/Consider: Apply app plugins? Or NOT!?
-                handlerOut = efn(req, res, e);
-            else:            
-                handlerOut = e.body;
-        except Exception as originalErr:
-            print("\n" + traceback.format_exc() + "\n");
-            # ^ Use `+`, not `,` to avoid space.
-            httpErr = HttpError(
-                "<h2>Internal Server Error</h2>", 500, "unexpected_error",
+            matched = e;    # Re-raised within runRoute(.), & handled.
+        if not isinstance(matched, HttpError) and checkAsyncHandler(matched.fn):
+            body = await runAsyncRoute(matched, req, res, receive, executor, timing);
+        else:
+            # Sync handler (or error), in a thread, without re-matching:
+            body = await loop.run_in_executor(
+                executor, runRoute, req, res, timing, matched,
             );
-            res.statusLine = httpErr.statusLine;
-            efn = app.frameworkErrorHandlerMap[httpErr._fwCode];
-            # ^ i.e. app.frameworkErrorHandlerMap["unexpected_error"];
-            #TODO/Consider: Apply app plugins? Or NOT!?
-            handlerOut = efn(req, res, originalErr);
-        return res._finish(handlerOut);
-    app.wsgi = wsgi;
+        if timing is not None:
+            endTiming(timing, res, body);
+        body = wrapBody(res, body);
+        await sendAsgiResponse(send, started, body, loop, executor);
+    app.asgi = asgi;
     
     # Return built `app`:
     return app;
 
+############################################################
+# Prefork Server: ##########################################
+############################################################
+
+SERVE_POLL_INTERVAL = 0.5;  # Secs, for workers to notice SIGTERM.
+SERVE_GRACE_TIMEOUT = 30;   # Secs, before SIGKILL-ing workers.
+
+class QuietRequestHandler (wsgiref.simple_server.WSGIRequestHandler):
+    "Like WSGIRequestHandler, sans per-request logging.";
+    def log_message (self, *args):
+        pass;
+
+def mkListenSocket (host, port, reusePort=False, backlog=128):
+    "Returns a bound, listening TCP socket, with accept() timeouts.";
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET;
+    sock = socket.socket(family, socket.SOCK_STREAM);
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1);
+    if reusePort:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1);
+    sock.bind((host, port));
+    sock.listen(backlog);
+    sock.settimeout(SERVE_POLL_INTERVAL);   # Workers race to accept(),
+    return sock;                            # & losers soon move on.
+
+def getPeakRss ():
+    "Returns peak resident memory of this process, in bytes.";
+    import resource;    # Unix only.
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss;
+    return maxrss if sys.platform == "darwin" else maxrss * 1024;
+
+def runWorker (app, sock, maxRequests=0, maxMemory=None, onWorkerStart=None):
+    "Serves requests on `sock`, until SIGTERM-ed or due for recycling.";
+    stopBox = [False];
+    signal.signal(signal.SIGTERM, lambda *a: stopBox.__setitem__(0, True));
+    signal.signal(signal.SIGINT, signal.SIG_IGN);   # Master handles it.
+    if onWorkerStart:
+        onWorkerStart(app);
+    countBox = [0];
+    def countingWsgi (environ, start_response):
+        countBox[0] += 1;
+        return app.wsgi(environ, start_response);
+    server = wsgiref.simple_server.WSGIServer(
+        sock.getsockname()[:2], QuietRequestHandler, bind_and_activate=False,
+    );
+    server.socket.close();
+    server.socket = sock;   # Shared (or reuse-port) listening socket.
+    server.server_name, server.server_port = sock.getsockname()[:2];
+    server.setup_environ();
+    server.set_app(countingWsgi);
+    server.timeout = SERVE_POLL_INTERVAL;
+    while not stopBox[0]:
+        server.handle_request();
+        if maxRequests and countBox[0] >= maxRequests:
+            break;
+        if maxMemory and getPeakRss() > maxMemory:
+            break;
+    sock.close();   # Queued connections remain, for sibling workers.
+
+def serve (
+        app, host="127.0.0.1", port=8000, workers=None, maxRequests=0,
+        maxMemory=None, reusePort=False, backlog=128, onWorkerStart=None,
+        graceTimeout=SERVE_GRACE_TIMEOUT,
+    ):
+    "Serves `app` via pre-forked worker processes. Unix only.";
+    if not hasattr(os, "fork"):
+        raise OSError("vilo.serve(.) requires os.fork(.)");
+    workers = workers or os.cpu_count() or 1;
+    app.warmUp();   # Pre-fork, so route tables are shared copy-on-write.
+    sock = mkListenSocket(host, port, reusePort, backlog);
+    # ^ Shared by workers. With `reusePort`, other processes (eg. a
+    #   newly deployed server) may bind the same port, too.
+    
+    def spawn ():
+        pid = os.fork();
+        if pid:
+            return pid;
+        # otherwise, in worker ...
+        exitCode = 0;
+        try:
+            runWorker(app, sock, maxRequests, maxMemory, onWorkerStart);
+        except BaseException as e:
+            print("\n" + formatTraceback(e) + "\n");
+            exitCode = 1;
+        finally:
+            sys.stdout.flush();
+            os._exit(exitCode);
+    
+    pidSet = set(spawn() for _ in range(workers));
+    stopBox = [None];   # Deadline, once stopping.
+    def onStop (signum, frame):
+        if stopBox[0] is None:
+            stopBox[0] = time.monotonic() + graceTimeout;
+            for pid in pidSet:
+                os.kill(pid, signal.SIGTERM);
+    oldHandlers = [signal.signal(sig, onStop) for sig in [signal.SIGTERM, signal.SIGINT]];
+    print("Serving on http://%s:%d with %d workers (pid %d)" % (
+        host, sock.getsockname()[1], workers, os.getpid(),
+    ));
+    sys.stdout.flush();
+    try:
+        while pidSet:
+            pid, status = os.waitpid(-1, os.WNOHANG);
+            if not pid:
+                if stopBox[0] is not None and time.monotonic() > stopBox[0]:
+                    for pid in pidSet:
+                        os.kill(pid, signal.SIGKILL);
+                    stopBox[0] = float("inf");
+                time.sleep(0.1);
+                continue;
+            pidSet.discard(pid);
+            if stopBox[0] is None:
+                if os.waitstatus_to_exitcode(status) != 0:
+                    time.sleep(1);  # Crashed, back off a bit.
+                pidSet.add(spawn());    # Recycle.
+    finally:
+        signal.signal(signal.SIGTERM, oldHandlers[0]);
+        signal.signal(signal.SIGINT, oldHandlers[1]);
+        sock.close();
+    return None;
+
 # End ######################################################